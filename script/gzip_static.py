@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__= '601996910@qq.com'
+
+'''
+Build step: write a .gz sibling for every compressible file under www/static,
+which StaticFileRoute serves to clients accepting gzip.
+    python script/gzip_static.py [static dir]
+'''
+
+import os, sys, gzip
+
+_EXTS = frozenset(['.css', '.js', '.html', '.htm', '.json', '.xml', '.txt', '.svg', '.eot', '.ttf', '.map'])
+
+def gzip_file(fpath, level=9):
+    '''
+    Compress fpath to fpath.gz with the same mtime. Return False if the .gz is
+    up to date or compression does not save anything.
+    '''
+    gzpath = fpath + '.gz'
+    mtime = os.path.getmtime(fpath)
+    if os.path.isfile(gzpath) and os.path.getmtime(gzpath) == mtime:
+        return False
+    with open(fpath, 'rb') as f:
+        data = f.read()
+    tmp = gzpath + '.tmp'
+    with open(tmp, 'wb') as f:
+        gz = gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=f, mtime=0)
+        gz.write(data)
+        gz.close()
+    if os.path.getsize(tmp) >= len(data):
+        os.remove(tmp)
+        if os.path.isfile(gzpath):
+            os.remove(gzpath)
+        return False
+    os.rename(tmp, gzpath)
+    os.utime(gzpath, (mtime, mtime))
+    return True
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'www', 'static')
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() in _EXTS:
+                fpath = os.path.join(dirpath, name)
+                if gzip_file(fpath):
+                    n = n + 1
+                    print '%s.gz' % fpath
+    print '%d file(s) compressed.' % n
+
+if __name__=='__main__':
+    main()
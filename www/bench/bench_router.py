@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__= '601996910@qq.com'
+
+'''
+Routing benchmark: linear scan over dynamic routes (the old fn_route)
+versus the Router segment trie, for a few hundred routes.
+    python bench/bench_router.py [routes]
+'''
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp.web import Route, Router, HttpError
+
+def make_routes(n):
+    routes = []
+    for i in range(n):
+        for path in ('/api/res%d' % i, '/api/res%d/:id' % i, '/res%d/:id/comments/:cid' % i):
+            fn = lambda *args: args
+            fn.__web_route__ = path
+            fn.__web_method__ = 'GET'
+            routes.append(Route(fn))
+    return routes
+
+def linear(routes):
+    static = dict((r.path, r) for r in routes if r.is_static)
+    dynamic = [r for r in routes if not r.is_static]
+    def match(path):
+        fn = static.get(path)
+        if fn:
+            return fn, ()
+        for fn in dynamic:
+            args = fn.match(path)
+            if args:
+                return fn, args
+        return None
+    return match
+
+def trie(routes):
+    router = Router()
+    for r in routes:
+        router.add(r)
+    def match(path):
+        try:
+            return router.match('GET', path)
+        except HttpError:
+            return None
+    return match
+
+def bench(match, path, loops):
+    start = time.time()
+    for i in xrange(loops):
+        match(path)
+    return (time.time() - start) / loops * 1000000
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    routes = make_routes(n)
+    paths = [
+        ('static', '/api/res%d' % (n - 1)),
+        ('first dynamic', '/api/res0/123'),
+        ('last dynamic', '/res%d/123/comments/456' % (n - 1)),
+        ('not found', '/nothing/here'),
+    ]
+    matchers = (('linear', linear(routes)), ('trie', trie(routes)))
+    print '%d routes' % len(routes)
+    print '%-16s %12s %12s' % ('path', 'linear (us)', 'trie (us)')
+    for title, path in paths:
+        print '%-16s %12.2f %12.2f' % ((title, ) + tuple([bench(m, path, 2000) for name, m in matchers]))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__= '601996910@qq.com'
+
+'''
+Micro-benchmark of row hydration: db.Dict + Model(**d) versus compact
+db.Row and the direct Model factory.
+Runs on synthetic cursor tuples so no database is needed:
+    python bench/bench_rows.py [rows]
+'''
+
+import os, sys, time, gc, logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.basicConfig(level=logging.WARNING)
+
+from transwarp import db
+from models import Blog
+
+def make_rows(n):
+    names = ('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'content', 'created_at')
+    now = time.time()
+    rows = [(db.next_id(), 'u%d' % (i % 100), u'user', u'about:blank', u'blog %d' % i, u'summary', u'content ' * 20, now) for i in xrange(n)]
+    return names, rows
+
+def hydrate_dict(names, rows):
+    # the old path: one Dict per row, then copied again into the model
+    return [Blog(**db.Dict(names, x)) for x in rows]
+
+def hydrate_row(names, rows):
+    return map(db.row_factory(names), rows)
+
+def hydrate_model(names, rows):
+    return map(Blog._factory(names), rows)
+
+def timeit(fn, names, rows, repeat=5):
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        fn(names, rows)
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+def row_size(obj):
+    n = sys.getsizeof(obj)
+    # per instance state such as a model's dirty set:
+    d = getattr(obj, '__dict__', None)
+    if d:
+        n = n + sys.getsizeof(d) + sum([sys.getsizeof(v) for v in d.itervalues()])
+    return n
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    names, rows = make_rows(n)
+    print '%d rows x %d columns' % (n, len(names))
+    print '%-24s %10s %12s' % ('path', 'time (ms)', 'bytes/row')
+    for title, fn in (('Dict + Model(**d)', hydrate_dict), ('row_factory (Row)', hydrate_row), ('Model._factory', hydrate_model)):
+        t = timeit(fn, names, rows)
+        print '%-24s %10.1f %12d' % (title, t * 1000, row_size(fn(names, rows[:1])[0]))
+
+if __name__=='__main__':
+    main()
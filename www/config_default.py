@@ -12,11 +12,53 @@ configs = {
             'port': 3306,
             'user': 'web_user',
             'passwd': 'web_pwd',
-            'db': 'web_db'
+            'db': 'web_db',
+            'pool': {
+                'min_size': 1,
+                'max_size': 10,
+                'timeout': 10,
+                'max_lifetime': 3600,
+                'max_idle': 300
+                },
+            'stmt_cache_size': 256,
+            'max_packet': 1048576,
+            # path of a SQLite database, e.g. a local read replica, to use instead of MySQL:
+            'sqlite': None
             },
         'session': {
-            'secret': 'AwRsOmE'
-            
+            'secret': 'AwRsOmE',
+            'cache_size': 10000,
+            'cache_ttl': 60
+            },
+        'web': {
+            'static_cache_size': 33554432
+            },
+        'server': {
+            # 0 for the single process debug server, None for one worker per CPU:
+            'workers': 0,
+            # 0 for one request at a time, otherwise threads per process:
+            'threads': 0,
+            # park idle keep-alive connections in a poll() loop instead of threads:
+            'event_loop': True,
+            'queue_size': 32,
+            'timeout': 30,
+            'keep_alive': 5,
+            'max_requests': 10000
+            },
+        'templates': {
+            'bytecode_cache': True,
+            'production': False,
+            'warm_up': True,
+            # send pages in chunks while rendering, a template error then cuts the
+            # response short instead of showing the 500 page:
+            'stream': False,
+            'chunk_size': 8192,
+            'fragment_cache': {
+                'size': 1000,
+                'ttl': 600,
+                # set a directory to share fragments between worker processes:
+                'directory': None
+                }
             }
         
         
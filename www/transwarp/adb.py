@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Asynchronous database API on top of transwarp.db.
+
+Every call is queued to a bounded pool of executor threads and returns a
+Future at once, so a request can start several queries and wait for all of
+them later. Executor threads use transwarp.db as usual, so connections come
+from the same connection pool.
+
+    f1 = adb.select('select * from blogs order by created_at desc limit ?', 10)
+    f2 = adb.select_int('select count(id) from comments')
+    blogs, count = f1.result(), f2.result()
+'''
+
+import os, sys, threading, logging, Queue
+
+import db
+
+logger = logging.getLogger(__name__)
+
+class TimeoutError(db.DBError):
+    pass
+
+class Future(object):
+    '''
+    Result of a call that runs on an executor thread.
+    >>> f = Future()
+    >>> f.done()
+    False
+    >>> f.result(timeout=0.01)
+    Traceback (most recent call last):
+      ...
+    TimeoutError: Future is not done in 0.01 seconds.
+    >>> f.add_done_callback(lambda f: sys.stdout.write('done: %s\\n' % f.result()))
+    >>> f.set_result(1)
+    done: 1
+    >>> f.result()
+    1
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise TimeoutError('Future is not done in %s seconds.' % timeout)
+
+    def result(self, timeout=None):
+        '''
+        Wait for the call and return its result, or raise its exception.
+        '''
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return None if self._exc_info is None else self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        '''
+        Call fn(future) when done, at once if done already.
+        '''
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, exc_info):
+        with self._cond:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                logger.exception(e)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        self._finish(None, exc_info)
+
+class Executor(object):
+    '''
+    Fixed number of threads running submitted calls in order.
+    >>> e = Executor(2)
+    >>> fs = [e.submit(lambda x: x * x, n) for n in range(5)]
+    >>> [f.result() for f in fs]
+    [0, 1, 4, 9, 16]
+    >>> e.submit(lambda: 1 / 0).result()
+    Traceback (most recent call last):
+      ...
+    ZeroDivisionError: integer division or modulo by zero
+    >>> e.shutdown()
+    '''
+    def __init__(self, max_workers=10, queue_size=0):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue(self.queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _check_pid(self):
+        '''
+        Start over after fork, as the threads of the parent do not exist in
+        the child. Calls queued in the parent are not run by the child.
+        '''
+        if self._pid != os.getpid():
+            logger.info('executor reset after fork.')
+            self._reset()
+
+    def _start(self):
+        self._check_pid()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Executor is shut down.')
+            if len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._work, name='adb-%d' % len(self._threads))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, fn, *args, **kw):
+        '''
+        Queue fn(*args, **kw) and return a Future of its result. It blocks if
+        queue_size calls are waiting already.
+        '''
+        f = Future()
+        self._start()
+        self._queue.put((f, fn, args, kw))
+        return f
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            f, fn, args, kw = item
+            try:
+                r = fn(*args, **kw)
+            except:
+                f.set_exception(sys.exc_info())
+            else:
+                f.set_result(r)
+
+    def shutdown(self, wait=True):
+        self._check_pid()
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for t in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def init(max_workers=None, queue_size=0):
+    '''
+    Create the global executor. max_workers defaults to the max size of the
+    connection pool, as more threads would only wait for connections.
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            raise db.DBError('Executor is already initialized')
+        if max_workers is None:
+            max_workers = db.engine.pool.max_size if db.engine is not None else 10
+        _executor = Executor(max_workers, queue_size)
+        logger.info('Init db executor with %d threads ok.' % max_workers)
+    return _executor
+
+def submit(fn, *args, **kw):
+    '''
+    Run fn(*args, **kw) on the db executor and return a Future.
+    '''
+    if _executor is None:
+        try:
+            init()
+        except db.DBError:
+            pass
+    return _executor.submit(fn, *args, **kw)
+
+def select(sql, *args, **kw):
+    return submit(db.select, sql, *args, **kw)
+
+def select_one(sql, *args, **kw):
+    return submit(db.select_one, sql, *args, **kw)
+
+def select_int(sql, *args):
+    return submit(db.select_int, sql, *args)
+
+def insert(table, **kw):
+    return submit(db.insert, table, **kw)
+
+def update(sql, *args):
+    return submit(db.update, sql, *args)
+
+def transaction(fn, *args, **kw):
+    '''
+    Run fn(*args, **kw) in one transaction on an executor thread, so all db
+    calls made by fn use the same connection. Return a Future of its result.
+    >>> def _move(n):
+    ...     db.update('update account set balance=balance-? where id=?', n, 1)
+    ...     db.update('update account set balance=balance+? where id=?', n, 2)
+    ...     if db.select_int('select balance from account where id=?', 1) < 0:
+    ...         raise ValueError('Not enough balance')
+    >>> r = update('create table account (id integer primary key, balance integer)').result()
+    >>> wait([insert('account', id=1, balance=100), insert('account', id=2, balance=0)])
+    [1, 1]
+    >>> transaction(_move, 30).result()
+    >>> transaction(_move, 100).result()
+    Traceback (most recent call last):
+      ...
+    ValueError: Not enough balance
+    >>> select('select * from account order by id').result()
+    [{'balance': 70, 'id': 1}, {'balance': 30, 'id': 2}]
+    '''
+    def _run():
+        with db.transaction():
+            return fn(*args, **kw)
+    return submit(_run)
+
+def wait(futures, timeout=None):
+    '''
+    Wait for all futures and return their results as list.
+    '''
+    return [f.result(timeout) for f in futures]
+
+if __name__=='__main__':
+    db.create_sqlite_engine(':memory:')
+    import doctest
+    doctest.testmod()
+    if _executor is not None:
+        _executor.shutdown()
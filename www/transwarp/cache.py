@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Process local caches.
+'''
+
+import os, time, hashlib, tempfile, threading, logging, cPickle as pickle
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class LRUCache(object):
+    '''
+    Thread safe LRU cache with an optional time to live per entry.
+    >>> c = LRUCache(maxsize=2, ttl=60)
+    >>> c.set('a', 1)
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b')
+    >>> c.get('c')
+    3
+    >>> c.set('d', 4, ttl=-1)
+    >>> c.get('d', 'expired')
+    'expired'
+    >>> c.evict(lambda k, v: v == 3)
+    1
+    >>> 'c' in c
+    False
+    >>> s = c.stats()
+    >>> s['hits'], s['misses'], s['size']
+    (2, 3, 0)
+
+    With maxweight, entries are also evicted until total weight fits:
+    >>> c = LRUCache(maxweight=100)
+    >>> c.set('a', 'x' * 60, weight=60)
+    >>> c.set('b', 'x' * 50, weight=50)
+    >>> 'a' in c, c.weight
+    (False, 50)
+    '''
+    def __init__(self, maxsize=1024, ttl=None, maxweight=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weight = 0
+        self._lock = threading.Lock()
+        # key -> (value, expires, weight), least recently used first:
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                if item[1] is None or item[1] > time.time():
+                    self._data[key] = item
+                    self.hits = self.hits + 1
+                    return item[0]
+                self.weight = self.weight - item[2]
+            self.misses = self.misses + 1
+            return default
+
+    def set(self, key, value, ttl=None, weight=0):
+        '''
+        Set value with ttl in seconds, default to the cache ttl. None means never expire.
+        Weight such as size in bytes counts against maxweight.
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (value, expires, weight)
+            self.weight = self.weight + weight
+            while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+                k, item = self._data.popitem(last=False)
+                self.weight = self.weight - item[2]
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.weight = self.weight - item[2]
+        return item
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def evict(self, predicate):
+        '''
+        Remove all entries for which predicate(key, value) is true and return the count.
+        '''
+        with self._lock:
+            L = [k for k, item in self._data.iteritems() if predicate(k, item[0])]
+            for k in L:
+                self._pop(k)
+        return len(L)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize, weight=self.weight, maxweight=self.maxweight)
+
+class FileCache(object):
+    '''
+    Cache with one file per entry in a directory, shared by all processes on
+    the same host. It has the same get/set/delete interface as LRUCache.
+    >>> c = FileCache(tempfile.mkdtemp(), ttl=60)
+    >>> c.set('a', u'fragment')
+    >>> c.get('a')
+    u'fragment'
+    >>> c.delete('a')
+    True
+    >>> c.get('a', 'gone')
+    'gone'
+    >>> c.set('b', 1, ttl=-1)
+    >>> 'b' in c
+    False
+    '''
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except IOError:
+            return default
+        except Exception, e:
+            logger.warning('Bad cache file for %s: %s' % (key, e))
+            return default
+        if expires is not None and expires <= time.time():
+            return default
+        return value
+
+    def set(self, key, value, ttl=None, weight=0):
+        '''
+        Set value with ttl in seconds, default to the cache ttl. Weight is ignored.
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        # write to a temp file and rename so readers never see a partial file:
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
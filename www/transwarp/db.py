@@ -8,7 +8,9 @@
 Database operation module
 copy and rewrite by myself
 """
-import time,uuid,functools,threading,logging
+import os,re,time,uuid,functools,operator,threading,logging
+
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -53,6 +55,72 @@ class Dict(dict):
     def __setattr__(self,key,value):
         self[key] = value
 
+_RE_IDENTIFIER = re.compile(r'^[a-zA-Z]\w*$')
+
+class Row(tuple):
+    '''
+    Tuple-backed result row that can be accessed as r.x, r['x'] or r[0].
+    Row classes are built once per column tuple by row_factory() and all rows
+    of a query share the same column index.
+    >>> R = row_factory(('id', 'name', 'count(*)'))
+    >>> r = R((1, 'Bob', 3))
+    >>> r.name
+    'Bob'
+    >>> r['id']
+    1
+    >>> r[1]
+    'Bob'
+    >>> r['count(*)']
+    3
+    >>> r._asdict()['name']
+    'Bob'
+    >>> r.empty
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'Row' object has no attribute 'empty'
+    >>> row_factory(('id', 'name', 'count(*)')) is R
+    True
+    '''
+    __slots__ = ()
+    _names = ()
+    _index = {}
+
+    def __getattr__(self, key):
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except KeyError:
+            raise AttributeError("'Row' object has no attribute '%s'" % key)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def _asdict(self):
+        return Dict(self._names, self)
+
+_row_classes = {}
+
+def row_factory(names):
+    '''
+    Row factory returning a Row subclass for the column names. Pass it as
+    factory to select(), select_one() or select_iter() to get compact rows.
+    '''
+    cls = _row_classes.get(names)
+    if cls is None:
+        attrs = dict(__slots__=(), _names=names, _index=dict((n, i) for i, n in enumerate(names)))
+        for i, n in enumerate(names):
+            if _RE_IDENTIFIER.match(n):
+                attrs[n] = property(operator.itemgetter(i))
+        cls = _row_classes[names] = type('Row', (Row,), attrs)
+    return cls
+
+def dict_factory(names):
+    '''
+    Default row factory returning each row as Dict.
+    '''
+    return lambda values: Dict(names, values)
+
 def next_id(t=None):
     if t is None:
         t = time.time()
@@ -70,31 +138,485 @@ class DBError(Exception):
 class MultiColumnsError(Exception):
     pass
 
-class _Engine(object):
-    def __init__(self,connect):
+_RE_DDL = re.compile(r'^\s*(create|alter|drop|rename)\s', re.IGNORECASE)
+# a quoted string or name, which may contain '?', or a placeholder:
+_RE_PLACEHOLDER = re.compile(r'\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*"|`[^`]*`|\?')
+
+class _Statement(object):
+    '''
+    A SQL statement with '?' placeholders rewritten for the driver's paramstyle.
+    names caches the column names of a select statement.
+    >>> st = _Statement('select * from user where id=? and name=?')
+    >>> st.sql
+    'select * from user where id=%s and name=%s'
+    >>> _Statement('select * from user where id=?', 'qmark').sql
+    'select * from user where id=?'
+    >>> st.nargs
+    2
+    >>> st.is_ddl
+    False
+    >>> _Statement('drop table if exists user').is_ddl
+    True
+    >>> st = _Statement("select * from user where name='what?' and id=?")
+    >>> st.sql, st.nargs
+    ("select * from user where name='what?' and id=%s", 1)
+    '''
+    __slots__ = ('sql', 'nargs', 'names', 'is_ddl', 'used')
+
+    def __init__(self, sql, paramstyle='format'):
+        placeholder = '%s' if paramstyle == 'format' else '?'
+        n = [0]
+        def _replace(m):
+            if m.group() != '?':
+                return m.group()
+            n[0] = n[0] + 1
+            return placeholder
+        self.sql = _RE_PLACEHOLDER.sub(_replace, sql)
+        self.nargs = n[0]
+        self.names = None
+        self.is_ddl = _RE_DDL.match(sql) is not None
+        self.used = 0
+
+class _StatementCache(object):
+    '''
+    Bounded LRU cache of _Statement keyed by the original SQL text.
+    When full, the least recently used quarter of entries is evicted.
+    >>> c = _StatementCache(maxsize=4)
+    >>> st = c.get('select * from user where id=?')
+    >>> c.get('select * from user where id=?') is st
+    True
+    >>> for i in range(4):
+    ...     st = c.get('select %d' % i)
+    >>> s = c.stats()
+    >>> s.hits, s.misses, s.size
+    (1, 5, 4)
+    >>> 'select * from user where id=?' in c
+    False
+    '''
+    def __init__(self, maxsize=256, paramstyle='format'):
+        self.maxsize = maxsize
+        self.paramstyle = paramstyle
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, sql):
+        return sql in self._cache
+
+    def get(self, sql):
+        with self._lock:
+            self._tick = self._tick + 1
+            st = self._cache.get(sql)
+            if st is not None:
+                self.hits = self.hits + 1
+                st.used = self._tick
+                return st
+            self.misses = self.misses + 1
+            st = _Statement(sql, self.paramstyle)
+            st.used = self._tick
+            if len(self._cache) >= self.maxsize:
+                self._evict()
+            if self.maxsize > 0:
+                self._cache[sql] = st
+            return st
+
+    def _evict(self):
+        L = sorted(self._cache.iteritems(), key=lambda kv: kv[1].used)
+        for k, v in L[:max(1, len(L) // 4)]:
+            del self._cache[k]
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._cache.clear()
+
+    def clear(self):
+        '''
+        Clear all cached statements, e.g. after DDL changed the columns of a table.
+        '''
+        with self._lock:
+            self._cache.clear()
+
+    def set_paramstyle(self, paramstyle):
+        with self._lock:
+            self.paramstyle = paramstyle
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return Dict(hits=self.hits, misses=self.misses, size=len(self._cache), maxsize=self.maxsize)
+
+_statements = _StatementCache()
+
+# max number of threads with checkout counters in pool stats:
+_MAX_THREAD_STATS = 256
+
+class _ConnectionPool(object):
+    '''
+    Bounded pool of DB-API connections shared by all threads.
+    Idle connections are reused LIFO, connections older than max_lifetime
+    are recycled and connections idle longer than max_idle are closed
+    as long as at least min_size connections stay open.
+    A forked child process starts with an empty pool of its own.
+    >>> n = [0]
+    >>> class _Conn(object):
+    ...     def rollback(self): pass
+    ...     def close(self): pass
+    >>> def _connect():
+    ...     n[0] = n[0] + 1
+    ...     return _Conn()
+    >>> pool = _ConnectionPool(_connect, max_size=2, timeout=0.01)
+    >>> c1 = pool.acquire()
+    >>> c2 = pool.acquire()
+    >>> pool.acquire()
+    Traceback (most recent call last):
+        ...
+    DBError: Timeout waiting for connection (max_size=2)
+    >>> pool.release(c1)
+    >>> pool.acquire() is c1
+    True
+    >>> n[0]
+    2
+    >>> s = pool.stats()
+    >>> s.creations, s.checkouts, s.timeouts, s.in_use
+    (2, 3, 1, 2)
+    >>> t = threading.Thread(target=lambda: pool.release(pool.acquire()), name='short-lived')
+    >>> pool.release(c2); t.start(); t.join()
+    >>> 'short-lived' in pool.stats().threads
+    False
+    '''
+    def __init__(self, connect, min_size=0, max_size=10, timeout=10, max_lifetime=3600, max_idle=300):
+        if max_size < 1 or min_size > max_size:
+            raise DBError('Invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
         self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        # connections inherited from parent process, never used nor closed:
+        self._orphans = []
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        # stack of (connection, created_at, released_at), most recently released last:
+        self._idle = []
+        # id(connection) -> created_at for every open connection:
+        self._created = {}
+        self._size = 0
+        self._stats = Dict(checkouts=0, waits=0, wait_time=0.0, timeouts=0, creations=0, recycles=0, reaped=0)
+        # thread name -> counters, oldest first:
+        self._thread_stats = OrderedDict()
+
+    def _check_pid(self):
+        '''
+        Start over after fork. Connections of the parent share sockets with it,
+        so they are kept referenced but never closed, because closing or
+        garbage collecting them would end the parent's sessions.
+        '''
+        if self._pid != os.getpid():
+            self._orphans.extend([item[0] for item in self._idle])
+            logger.info('pool reset after fork, %d connection(s) orphaned.' % len(self._idle))
+            self._reset()
+
+    def _expired(self, created_at, now):
+        return self.max_lifetime and now - created_at > self.max_lifetime
+
+    def _forget(self, connection):
+        self._created.pop(id(connection), None)
+        self._size = self._size - 1
+
+    def _reap(self, now, garbage):
+        if not self.max_idle:
+            return
+        while self._idle and self._size > self.min_size and now - self._idle[0][2] > self.max_idle:
+            connection = self._idle.pop(0)[0]
+            self._forget(connection)
+            self._stats.reaped = self._stats.reaped + 1
+            garbage.append(connection)
+
+    def _count(self, waited, wait_time):
+        self._stats.checkouts = self._stats.checkouts + 1
+        name = threading.current_thread().name
+        ts = self._thread_stats.get(name)
+        if ts is None:
+            if len(self._thread_stats) >= _MAX_THREAD_STATS:
+                self._prune_thread_stats()
+            ts = self._thread_stats[name] = Dict(checkouts=0, waits=0, wait_time=0.0)
+        ts.checkouts = ts.checkouts + 1
+        if waited:
+            self._stats.waits = self._stats.waits + 1
+            self._stats.wait_time = self._stats.wait_time + wait_time
+            ts.waits = ts.waits + 1
+            ts.wait_time = ts.wait_time + wait_time
+
+    def _prune_thread_stats(self):
+        '''
+        Drop counters of threads no longer alive. If all are alive, drop the
+        oldest half so short-lived threads can not grow the dict unbounded.
+        '''
+        alive = set([t.name for t in threading.enumerate()])
+        for name in [k for k in self._thread_stats if not k in alive]:
+            del self._thread_stats[name]
+        if len(self._thread_stats) >= _MAX_THREAD_STATS:
+            for name in self._thread_stats.keys()[:_MAX_THREAD_STATS // 2]:
+                del self._thread_stats[name]
+
+    def acquire(self):
+        '''
+        Borrow a connection, creating one if the pool is not full, otherwise
+        wait up to timeout seconds for another thread to release one.
+        '''
+        self._check_pid()
+        start = time.time()
+        deadline = start + self.timeout
+        waited = False
+        garbage = []
+        try:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    self._reap(now, garbage)
+                    while self._idle:
+                        connection, created_at, released_at = self._idle.pop()
+                        if self._expired(created_at, now):
+                            self._forget(connection)
+                            self._stats.recycles = self._stats.recycles + 1
+                            garbage.append(connection)
+                            continue
+                        self._count(waited, now - start)
+                        return connection
+                    if self._size < self.max_size:
+                        self._size = self._size + 1
+                        self._count(waited, now - start)
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats.timeouts = self._stats.timeouts + 1
+                        raise DBError('Timeout waiting for connection (max_size=%d)' % self.max_size)
+                    waited = True
+                    self._cond.wait(remaining)
+        finally:
+            self._close_all(garbage)
+        try:
+            connection = self._connect()
+        except:
+            with self._cond:
+                self._size = self._size - 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(connection)] = time.time()
+            self._stats.creations = self._stats.creations + 1
+        logger.info('open connection <%s>...' % hex(id(connection)))
+        return connection
+
+    def release(self, connection):
+        '''
+        Return a connection to the pool. Any uncommitted work is rolled back
+        so the next borrower starts from a clean state.
+        '''
+        self._check_pid()
+        if not id(connection) in self._created:
+            # borrowed before fork:
+            self._orphans.append(connection)
+            return
+        garbage = []
+        try:
+            connection.rollback()
+            broken = False
+        except Exception, e:
+            logger.warning('discard broken connection <%s>: %s' % (hex(id(connection)), e))
+            broken = True
+        with self._cond:
+            now = time.time()
+            created_at = self._created.get(id(connection), now)
+            if broken or self._expired(created_at, now):
+                self._forget(connection)
+                if not broken:
+                    self._stats.recycles = self._stats.recycles + 1
+                garbage.append(connection)
+            else:
+                self._idle.append((connection, created_at, now))
+            self._reap(now, garbage)
+            self._cond.notify()
+        self._close_all(garbage)
+
+    def _close_all(self, connections):
+        for connection in connections:
+            logger.info('close connection <%s>...' % hex(id(connection)))
+            try:
+                connection.close()
+            except Exception, e:
+                logger.warning('close connection failed: %s' % e)
+
+    def stats(self):
+        '''
+        Return a snapshot of pool counters as Dict.
+        '''
+        with self._cond:
+            s = Dict(**self._stats)
+            s.size = self._size
+            s.idle = len(self._idle)
+            s.in_use = self._size - len(self._idle)
+            s.max_size = self.max_size
+            self._prune_thread_stats()
+            s.threads = dict((k, Dict(**v)) for k, v in self._thread_stats.iteritems())
+        return s
+
+class _Engine(object):
+    '''
+    Base class of database backends. A backend opens connections for the
+    pool and knows the dialect of its database: the driver's paramstyle,
+    how to quote names and column types in DDL, and what lastrowid means.
+    The dialect methods are class methods, so SQL can be generated before
+    an engine is created.
+    '''
+    name = None
+    # paramstyle of the driver, '?' placeholders are rewritten to it:
+    paramstyle = 'qmark'
+    # cursor class for select_iter(), None for the default cursor:
+    stream_cursorclass = None
+    # column types not understood by the database, see column_type():
+    types = {}
+
+    def __init__(self, max_packet=1024*1024, **pool_kw):
+        self._pool = _ConnectionPool(self._connect, **pool_kw)
+        self.max_packet = max_packet
+    @property
+    def pool(self):
+        return self._pool
     def connect(self):
-        return self._connect()
+        return self._pool.acquire()
+    def release(self, connection):
+        self._pool.release(connection)
+    def _connect(self):
+        raise NotImplementedError('Engine must implement _connect()')
+
+    @classmethod
+    def quote(cls, name):
+        return '`%s`' % name
+
+    @classmethod
+    def column_type(cls, ddl):
+        return cls.types.get(ddl.lower(), ddl)
+
+    @classmethod
+    def lastrowid(cls, cursor):
+        '''
+        Return the id generated by the last insert on cursor, or None.
+        '''
+        return cursor.lastrowid
+
+class _MySQLEngine(_Engine):
+    name = 'mysql'
+    paramstyle = 'format'
+
+    def __init__(self, params, max_packet=1024*1024, **pool_kw):
+        import MySQLdb, MySQLdb.cursors
+        super(_MySQLEngine, self).__init__(max_packet, **pool_kw)
+        self._driver = MySQLdb
+        self._params = params
+        self.stream_cursorclass = MySQLdb.cursors.SSCursor
+    def _connect(self):
+        return self._driver.connect(**self._params)
+
+    @classmethod
+    def lastrowid(cls, cursor):
+        # AUTO_INCREMENT value, 0 if the table has none:
+        return cursor.lastrowid or None
+
+# tuned for many readers and few writers:
+_SQLITE_PRAGMAS = dict(
+    # readers never block the writer and see a consistent snapshot:
+    journal_mode='WAL',
+    # with WAL, fsync only at checkpoints, a crash keeps the database consistent:
+    synchronous='NORMAL',
+    temp_store='MEMORY',
+    # page cache per connection in KiB:
+    cache_size=-16000,
+    mmap_size=256*1024*1024)
+
+class _SQLiteEngine(_Engine):
+    '''
+    Embedded SQLite database. Connections are shared by threads through the
+    pool and return byte strings like MySQLdb does. An in-memory database
+    exists per connection, so ':memory:' uses a pool of one connection.
+    >>> e = _SQLiteEngine(':memory:')
+    >>> e.pool.max_size
+    1
+    >>> c = e.connect()
+    >>> cursor = c.cursor()
+    >>> r = cursor.execute('create table t (id integer primary key, name text)')
+    >>> r = cursor.execute('insert into t (name) values (?)', ('a',))
+    >>> e.lastrowid(cursor), c.execute('select name from t').fetchone()
+    (1, ('a',))
+    >>> e.release(c)
+    >>> _SQLiteEngine.quote('user'), _SQLiteEngine.column_type('bool')
+    ('"user"', 'integer')
+
+    Pool options are passed as a dict, its timeout is the checkout timeout:
+    >>> e = _SQLiteEngine(':memory:', busy_timeout=1, pool=dict(timeout=10, max_size=4))
+    >>> e.pool.timeout, e.busy_timeout
+    (10, 1)
+    '''
+    name = 'sqlite'
+    types = dict(bool='integer', blod='blob')
+
+    def __init__(self, database, busy_timeout=5, pragmas=None, max_packet=1024*1024, pool=None):
+        import sqlite3
+        pool_kw = dict(pool or {})
+        if database == ':memory:':
+            pool_kw.update(min_size=1, max_size=1, max_lifetime=None, max_idle=None)
+        super(_SQLiteEngine, self).__init__(max_packet, **pool_kw)
+        self._driver = sqlite3
+        self.database = database
+        # seconds to wait for a lock held by another connection:
+        self.busy_timeout = busy_timeout
+        self.pragmas = dict(_SQLITE_PRAGMAS)
+        self.pragmas.update(pragmas or {})
+    def _connect(self):
+        connection = self._driver.connect(self.database, timeout=self.busy_timeout, check_same_thread=False)
+        connection.text_factory = str
+        for k, v in self.pragmas.iteritems():
+            connection.execute('pragma %s=%s' % (k, v))
+        return connection
+
+    @classmethod
+    def quote(cls, name):
+        return '"%s"' % name
+
+    @classmethod
+    def lastrowid(cls, cursor):
+        # rowid of the inserted row, None after other statements:
+        return cursor.lastrowid
 
 class _LasyConnection(object):
     def __init__(self):
         self.connection = None
-    def cursor(self):
+    def cursor(self, *args):
         if self.connection is None:
             connection = engine.connect()
-            logger.info('open connection <%s>...' % hex(id(connection)))
+            logger.info('borrow connection <%s>...' % hex(id(connection)))
             self.connection = connection
-        return self.connection.cursor()
+        return self.connection.cursor(*args)
     def commit(self):
-        self.connection.commit()
+        # nothing to commit if no connection was borrowed:
+        if self.connection is not None:
+            self.connection.commit()
     def rollback(self):
-        self.connection.rollback()
+        if self.connection is not None:
+            self.connection.rollback()
     def cleanup(self):
         if self.connection:
             connection = self.connection
             self.connection = None
-            logger.info('close connection <%s>...' % hex(id(connection)))
-            connection.close()
+            logger.info('return connection <%s>...' % hex(id(connection)))
+            engine.release(connection)
 
 class _DbCtx(threading.local):
     '''
@@ -103,6 +625,7 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.lastrowid = None
     def is_init(self):
         return not self.connection is None
 
@@ -113,23 +636,72 @@ class _DbCtx(threading.local):
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
-    def cursor(self):
-        return self.connection.cursor()
+    def cursor(self, *args):
+        return self.connection.cursor(*args)
 _db_ctx = _DbCtx()
 
 
 
 #global engine object
 engine = None
-def create_engine(user,passwd,db,host='127.0.0.1',port=3306,**kw):
-    import MySQLdb
+def _init_engine(e, stmt_cache_size):
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized')
+    engine = e
+    _statements.set_paramstyle(e.paramstyle)
+    if stmt_cache_size is not None:
+        _statements.resize(stmt_cache_size)
+    logger.info('Init %s engine <%s> ok.' % (e.name, hex(id(e))))
+
+def create_engine(user,passwd,db,host='127.0.0.1',port=3306,pool=None,stmt_cache_size=None,max_packet=1024*1024,**kw):
+    '''
+    Init the global engine. pool is a dict of connection pool options
+    (min_size, max_size, timeout, max_lifetime, max_idle), stmt_cache_size
+    bounds the statement cache, max_packet should not exceed the server's
+    max_allowed_packet and bounds bulk inserts, other keyword arguments are
+    passed to MySQLdb.connect().
+    '''
     params = dict(user=user, passwd=passwd, db=db,host=host,port=port)
-    #NOTE return func not a connection
-    engine =_Engine(lambda: MySQLdb.connect(**params))
-    logger.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+    params.update(kw)
+    _init_engine(_MySQLEngine(params, max_packet, **(pool or {})), stmt_cache_size)
+
+def create_sqlite_engine(database, pool=None, stmt_cache_size=None, max_packet=1024*1024, busy_timeout=5, pragmas=None):
+    '''
+    Init the global engine with a SQLite database file, or ':memory:'.
+    pragmas is a dict applied to each new connection on top of the
+    defaults, which turn on WAL mode. busy_timeout is the seconds to wait
+    for a lock, other arguments are the same as create_engine().
+    '''
+    _init_engine(_SQLiteEngine(database, busy_timeout, pragmas, max_packet, pool), stmt_cache_size)
+
+def dialect():
+    '''
+    Return the global engine, or the MySQL engine class if it is not
+    initialized yet, to generate SQL for.
+    '''
+    return engine if engine is not None else _MySQLEngine
+
+def last_insert_id():
+    '''
+    Return the id generated by the last insert of this thread, or None.
+    With MySQL it is the AUTO_INCREMENT value, with SQLite the rowid.
+    '''
+    return _db_ctx.lastrowid
+
+def pool_stats():
+    '''
+    Return connection pool counters of the global engine, see _ConnectionPool.stats().
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    return engine.pool.stats()
+
+def statement_cache_stats():
+    '''
+    Return hits, misses, size and maxsize of the statement cache as Dict.
+    '''
+    return _statements.stats()
 
 class _ConnectionCtx(object):
     '''
@@ -242,7 +814,7 @@ def transaction():
     []
 
     '''
-    return _TransactioCtx()
+    return _TransactionCtx()
 
 def with_transaction(func):
     '''
@@ -273,33 +845,48 @@ def with_transaction(func):
     return _wrapper
     
 
-def _select(sql, first, *args):
+def _prepare(sql, args):
+    st = _statements.get(sql)
+    if len(args) != st.nargs:
+        raise DBError('Expect %d arguments but got %d: %s' % (st.nargs, len(args), sql))
+    return st
+
+def _column_names(st, cursor):
+    names = st.names
+    description = cursor.description
+    if not description:
+        return ()
+    if names is None or len(names) != len(description):
+        names = st.names = tuple([x[0] for x in description])
+    return names
+
+def _select(sql, first, *args, **kw):
     '''execute select SQL and return unique result or list results.'''
     cursor = None
-    sql = sql.replace('?','%s')
+    st = _prepare(sql, args)
     try:
         #cursor = engine.connect().cursor()
         cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql,args)
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
+        cursor.execute(st.sql,args)
+        make = kw.get('factory', dict_factory)(_column_names(st, cursor))
         if first:
             values = cursor.fetchone()
             if not values:
                 return None
-            return Dict(names,values)
-        return [Dict(names,x) for x in cursor] #FIXME
+            return make(values)
+        return map(make, cursor.fetchall())
     finally:
         if cursor:
             cursor.close()
 
 
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
     '''
     Execute select SQL and expected one result. 
     If no result found, return None.
     If multiple results found, the first one returned.
+    Pass factory=row_factory to get a compact Row instead of Dict.
     >>> u1 = dict(id=100, name='Alice', email='alice@test.org', passwd='ABC-12345', last_modified=time.time())
     >>> u2 = dict(id=101, name='Sarah', email='sarah@test.org', passwd='ABC-12345', last_modified=time.time())
     >>> insert('user', **u1)
@@ -313,8 +900,11 @@ def select_one(sql, *args):
     >>> u2 = select_one('select * from user where passwd=? order by email', 'ABC-12345')
     >>> u2.name
     'Alice'
+    >>> r = select_one('select id, name from user where id=?', 101, factory=row_factory)
+    >>> r.name, r[0]
+    ('Sarah', 101L)
     '''
-    return _select(sql,True,*args)
+    return _select(sql,True,*args,**kw)
 
 @with_connection
 def select_int(sql, *args):
@@ -346,9 +936,10 @@ def select_int(sql, *args):
     return d.values()[0]
 
 @with_connection
-def select(sql, *args):
+def select(sql, *args, **kw):
     '''
     Execute select SQL and return list or empty list if no result.
+    Pass factory=row_factory to get compact Rows instead of Dicts.
     >>> u1 = dict(id=200, name='Wall.E', email='wall.e@test.org', passwd='back-to-earth', last_modified=time.time())
     >>> u2 = dict(id=201, name='Eva', email='eva@test.org', passwd='back-to-earth', last_modified=time.time())
     >>> insert('user', **u1)
@@ -366,18 +957,72 @@ def select(sql, *args):
     'Eva'
     >>> L[1].name
     'Wall.E'
+    >>> L = select('select * from user where passwd=? order by id desc', 'back-to-earth', factory=row_factory)
+    >>> L[0].name, L[1]['name']
+    ('Eva', 'Wall.E')
+    '''
+    return _select(sql,False,*args,**kw)
+
+def select_iter(sql, *args, **kw):
+    '''
+    Execute select SQL and return a generator of results. Rows are read from
+    a server-side cursor batch_size rows at a time, so large results can be
+    walked in constant memory.
+    Outside a transaction a connection is borrowed from the pool until the
+    generator is exhausted or closed. Inside a transaction the transaction's
+    connection is used, so exhaust or close the generator before executing
+    another statement.
+    >>> u1 = dict(id=300, name='Tom', email='tom@test.org', passwd='cat', last_modified=time.time())
+    >>> u2 = dict(id=301, name='Jerry', email='jerry@test.org', passwd='mouse', last_modified=time.time())
+    >>> u3 = dict(id=302, name='Spike', email='spike@test.org', passwd='dog', last_modified=time.time())
+    >>> for u in (u1, u2, u3):
+    ...     r = insert('user', **u)
+    >>> it = select_iter('select * from user where id>=? and id<? order by id', 300, 303, batch_size=2)
+    >>> [u.name for u in it]
+    ['Tom', 'Jerry', 'Spike']
     '''
-    return _select(sql,False,*args)
+    batch_size = kw.pop('batch_size', 1000)
+    factory = kw.pop('factory', dict_factory)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+    return _select_iter(_prepare(sql, args), args, batch_size, factory)
+
+def _select_iter(st, args, batch_size, factory):
+    borrowed = None
+    cursor = None
+    try:
+        cursorclass = engine.stream_cursorclass
+        if _db_ctx.is_init() and _db_ctx.transactions > 0:
+            cursor = _db_ctx.cursor(cursorclass) if cursorclass else _db_ctx.cursor()
+        else:
+            borrowed = engine.connect()
+            cursor = borrowed.cursor(cursorclass) if cursorclass else borrowed.cursor()
+        cursor.execute(st.sql, args)
+        make = factory(_column_names(st, cursor))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield make(row)
+    finally:
+        if cursor:
+            cursor.close()
+        if borrowed is not None:
+            engine.release(borrowed)
 
 @with_connection
 def _update(sql, *args):
     cursor = None
-    sql = sql.replace('?','%s')
-    logger.info('SQL: %s,ARGS: %s' %(sql,args))
+    st = _prepare(sql, args)
+    logger.info('SQL: %s,ARGS: %s' %(st.sql,args))
     try:
         #cursor = engine.connect().cursor()
         cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql,args)
+        cursor.execute(st.sql,args)
+        if st.is_ddl:
+            _statements.clear()
+        _db_ctx.lastrowid = engine.lastrowid(cursor)
         r = cursor.rowcount
         if _db_ctx.transactions == 0:
             logger.info('auto commit')
@@ -387,6 +1032,103 @@ def _update(sql, *args):
         if cursor:
             cursor.close()
 
+def _estimate_size(args):
+    n = 4
+    for arg in args:
+        n = n + (len(arg) if isinstance(arg, basestring) else 20) + 3
+    return n
+
+def _chunks(seq, max_size, max_rows=1000):
+    '''
+    Split argument tuples into chunks whose estimated packet size stays under max_size.
+    >>> [len(c) for c in _chunks([('x' * 10,)] * 10, 60)]
+    [3, 3, 3, 1]
+    '''
+    chunk = []
+    size = 0
+    for args in seq:
+        n = _estimate_size(args)
+        if chunk and (size + n > max_size or len(chunk) >= max_rows):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(args)
+        size = size + n
+    if chunk:
+        yield chunk
+
+@with_connection
+def _update_many(sql, seq):
+    cursor = None
+    st = _statements.get(sql)
+    logger.info('SQL: %s,ROWS: %s' %(st.sql,len(seq)))
+    try:
+        cursor = _db_ctx.connection.cursor()
+        r = 0
+        # leave room for the statement itself:
+        for chunk in _chunks(seq, engine.max_packet - len(st.sql) - 1024):
+            for args in chunk:
+                if len(args) != st.nargs:
+                    raise DBError('Expect %d arguments but got %d: %s' % (st.nargs, len(args), sql))
+            cursor.executemany(st.sql, chunk)
+            r = r + cursor.rowcount
+        if _db_ctx.transactions == 0:
+            logger.info('auto commit')
+            _db_ctx.connection.commit()
+        return r
+    finally:
+        if cursor:
+            cursor.close()
+
+def update_many(sql, seq):
+    '''
+    Execute update SQL once for each argument tuple in seq with executemany(),
+    and commit once if not in a transaction. Return the total affected rows.
+    >>> L = [(900 + i, 'Many%d' % i, 'many%d@test.org' % i, 'many', time.time()) for i in range(3)]
+    >>> update_many('insert into user (id, name, email, passwd, last_modified) values (?,?,?,?,?)', L)
+    3L
+    >>> update_many('update user set passwd=? where id=?', [('new', 900), ('new', 901)])
+    2L
+    >>> update_many('update user set passwd=? where id=?', [])
+    0
+    '''
+    seq = list(seq)
+    if not seq:
+        return 0
+    return _update_many(sql, seq)
+
+def insert_many(table, rows):
+    '''
+    Execute insert SQL for many rows given as dicts. Rows are grouped by their
+    column set and written with executemany() in chunks bounded by max_packet,
+    committed once. Return the number of inserted rows.
+    >>> L = [dict(id=3000 + i, name='Bulk%d' % i, email='bulk%d@test.org' % i, passwd='bulk', last_modified=time.time()) for i in range(10)]
+    >>> L.append(dict(id=3010, name='Partial', passwd='bulk'))
+    >>> insert_many('user', L)
+    11L
+    >>> select_int('select count(*) from user where passwd=?', 'bulk')
+    11L
+    >>> insert_many('user', [])
+    0
+    '''
+    rows = list(rows)
+    if not rows:
+        return 0
+    groups = {}
+    order = []
+    for row in rows:
+        cols = tuple(sorted(row))
+        if not cols in groups:
+            groups[cols] = []
+            order.append(cols)
+        groups[cols].append(tuple([row[col] for col in cols]))
+    r = 0
+    with _TransactionCtx():
+        for cols in order:
+            sql = 'insert into `%s` (%s) values (%s)' % (table,','.join(['`%s`'% col for col in cols]),','.join(['?' for i in range(len(cols))]))
+            r = r + _update_many(sql, groups[cols])
+    return r
+
 def insert(table, **kw):
     '''
     Execute insert SQL.
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Jinja2 extension for caching rendered template fragments:
+
+    {% cache 'blogs', 300 %}
+        ...
+    {% endcache %}
+
+The rendered fragment is kept in environment.fragment_cache under the given
+key for ttl seconds (default to the storage ttl). The storage is any object
+with get(key) and set(key, value, ttl) such as LRUCache or FileCache, so a
+model write can invalidate a fragment by fragment_cache.delete(key).
+'''
+
+import logging
+
+from jinja2 import nodes, Markup
+from jinja2.ext import Extension
+
+logger = logging.getLogger(__name__)
+
+class FragmentCacheExtension(Extension):
+    '''
+    >>> from jinja2 import Environment
+    >>> from cache import LRUCache
+    >>> env = Environment(extensions=[FragmentCacheExtension])
+    >>> env.fragment_cache = LRUCache()
+    >>> t = env.from_string('{% cache "k", 60 %}{{ n }}{% endcache %}')
+    >>> t.render(n=1)
+    u'1'
+    >>> t.render(n=2)
+    u'1'
+    >>> env.fragment_cache.delete('k')
+    True
+    >>> t.render(n=3)
+    u'3'
+    '''
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_fragment', args), [], [], body).set_lineno(lineno)
+
+    def _cache_fragment(self, key, ttl, caller):
+        storage = self.environment.fragment_cache
+        if storage is None:
+            return caller()
+        value = storage.get(key)
+        if value is None:
+            value = caller()
+            storage.set(key, unicode(value), ttl)
+        # the fragment was escaped when rendered:
+        return Markup(value)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -8,8 +8,12 @@ __author__= '601996910@qq.com'
 
 import time
 import logging
+import functools
+import threading
+from itertools import izip
 
 import db
+import adb
 
 logger = logging.getLogger(__name__)
 
@@ -97,23 +101,127 @@ class VersionField(Field):
 _triggers = frozenset(['pre_insert','pre_update','pre_delete'])
 
 def _gen_sql(table_name, mappings,checkfirst=True):
+    '''
+    Generate create table SQL in the dialect of the current db engine.
+    '''
+    d = db.dialect()
+    q = d.quote
     pk = None
     if checkfirst:
-        sql=['-- generating SQL for %s:' % table_name, 'create table if not exists `%s` (' % table_name]
+        sql=['-- generating SQL for %s:' % table_name, 'create table if not exists %s (' % q(table_name)]
     else:
-        sql=['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
+        sql=['-- generating SQL for %s:' % table_name, 'create table %s (' % q(table_name)]
     for f in sorted(mappings.values(),lambda x, y: cmp(x._order,y._order)):
         if not hasattr(f,'ddl'):
             raise StandardError('no ddl in field "%s".' %f)
-        ddl = f.ddl
+        ddl = d.column_type(f.ddl)
         nullable = f.nullable
         if f.primary_key:
             pk = f.name
-        sql.append(nullable and '  `%s` %s,' %(f.name,ddl) or '  `%s` %s not null,' %(f.name,ddl))
-    sql.append('  primary key(`%s`)' %pk)
+        sql.append(nullable and '  %s %s,' %(q(f.name),ddl) or '  %s %s not null,' %(q(f.name),ddl))
+    sql.append('  primary key(%s)' %q(pk))
     sql.append(');')
     return '\n'.join(sql)
 
+def _compile_sqls(table_name, mappings, primary_key, attrs):
+    '''
+    Precompute ordered (attr, field) tuples and the SQL used by Model methods,
+    so instance methods only have to gather values.
+    '''
+    fields = tuple(sorted(mappings.iteritems(), key=lambda kv: kv[1]._order))
+    insert_fields = tuple([(k, f) for k, f in fields if f.insertable])
+    update_fields = tuple([(k, f) for k, f in fields if f.updatable])
+    pk = primary_key.name
+    attrs['__fields__'] = fields
+    attrs['__insert_fields__'] = insert_fields
+    attrs['__update_fields__'] = update_fields
+    attrs['__select_sql__'] = 'select * from `%s`' % table_name
+    attrs['__select_pk_sql__'] = 'select * from `%s` where `%s`=?' % (table_name, pk)
+    attrs['__count_sql__'] = 'select count(`%s`) from `%s`' % (pk, table_name)
+    attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?' % (table_name, pk)
+    attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (table_name, ','.join(['`%s`' % f.name for k, f in insert_fields]), ','.join(['?' for i in range(len(insert_fields))]))
+    # update statements keyed by the tuple of changed attributes:
+    attrs['__update_sqls__'] = {}
+    attrs['__update_sql__'] = _update_sql(table_name, update_fields, pk) if update_fields else None
+    if update_fields:
+        attrs['__update_sqls__'][tuple([k for k, f in update_fields])] = attrs['__update_sql__']
+
+def _update_sql(table_name, fields, pk):
+    return 'update `%s` set %s where `%s`=?' % (table_name, ','.join(['`%s`=?' % f.name for k, f in fields]), pk)
+
+_events = frozenset(['post_insert','post_update','post_delete'])
+_listeners = {}
+
+def listen(model, event):
+    '''
+    A decorator that registers fn to be called after a write of model.
+    post_insert and post_delete listeners get the object, post_update
+    listeners also get the tuple of written attribute names.
+    @listen(User, 'post_update')
+    def on_user_update(user, names):
+        pass
+    '''
+    if not event in _events:
+        raise ValueError('Invalid event: %s' % event)
+    def _decorator(fn):
+        _listeners.setdefault((model, event), []).append(fn)
+        return fn
+    return _decorator
+
+def _notify(obj, event, *args):
+    L = _listeners.get((obj.__class__, event))
+    if L:
+        for fn in L:
+            fn(obj, *args)
+
+class _IdentityMapCtx(threading.local):
+    '''
+    Thread local object that holds the identity map, a dict of loaded
+    objects keyed by (model class, primary key), or None if not enabled.
+    '''
+    def __init__(self):
+        self.objects = None
+_identity_ctx = _IdentityMapCtx()
+
+class _IdentityMapScope(object):
+    '''
+    _IdentityMapScope object that enables the identity map. Scopes can be
+    nested and only the most outer one clears the map on exit.
+    '''
+    def __enter__(self):
+        self.should_cleanup = False
+        if _identity_ctx.objects is None:
+            _identity_ctx.objects = {}
+            self.should_cleanup = True
+        return self
+    def __exit__(self, exctype, excvalue, traceback):
+        if self.should_cleanup:
+            _identity_ctx.objects = None
+
+def identity_map():
+    '''
+    Enable the identity map so repeated loads of the same primary key return
+    the same object: Model.get() consults the map first, get(), find_first(),
+    find_by() and find_all() populate it, update() and delete() invalidate it.
+    Writes made with raw db.update() are not tracked.
+    with identity_map():
+        pass
+    '''
+    return _IdentityMapScope()
+
+def with_identity_map(func):
+    '''
+    @with_identity_map
+    def foo(*args, **kw):
+        User.get(id)
+        User.get(id)
+    '''
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        with _IdentityMapScope():
+            return func(*args, **kw)
+    return _wrapper
+
 class ModelMetaclass(type):
     '''
     Metaclass for model objects.
@@ -125,12 +233,12 @@ class ModelMetaclass(type):
         # store all subclasses info
         if not hasattr(cls,'subclasses'):
             cls.subclasses = {}
-            cls.sqls = {}
-            cls.check_sqls = {}
+            # name -> (table, mappings), create table SQL is generated on use
+            # in the dialect of the engine:
+            cls.tables = {}
         if not name in cls.subclasses:
             cls.subclasses[name] = name
-            cls.sqls[name] = None
-            cls.check_sqls[name] = None
+            cls.tables[name] = None
         else:
             logger.waring('Redefine class: %s ' % name)
 
@@ -164,8 +272,8 @@ class ModelMetaclass(type):
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
         attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'],mappings) #FIXME
-        cls.sqls[name] = _gen_sql(attrs['__table__'],mappings,checkfirst=False)
-        cls.check_sqls[name] = _gen_sql(attrs['__table__'],mappings)
+        _compile_sqls(attrs['__table__'], mappings, primary_key, attrs)
+        cls.tables[name] = (attrs['__table__'], mappings)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
@@ -195,8 +303,15 @@ class Model(dict):
     'Michael'
     >>> f.email
     'orm@db.org'
+    >>> f._dirty
+    frozenset([])
     >>> f.email = 'changed@db.org'
+    >>> f.name = 'Bob'
+    >>> sorted(f._dirty)
+    ['email', 'name']
     >>> r = f.update() # change email but email is non-updatable!
+    >>> f._dirty
+    frozenset([])
     >>> len(User.find_all())
     1
     >>> g = User.get(10190)
@@ -219,8 +334,24 @@ class Model(dict):
     '''
     __metaclass__ = ModelMetaclass
 
+    # names of attributes modified since load or last save. A clean object
+    # has no set of its own, so loaded rows do not pay for one:
+    _dirty = frozenset()
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        if kw:
+            self.__dict__['_dirty'] = set(kw)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None:
+            dirty = self.__dict__['_dirty'] = set()
+        dirty.add(key)
+
+    def _clean(self):
+        self.__dict__.pop('_dirty', None)
 
     def __getattr__(self,key):
         try:
@@ -233,106 +364,216 @@ class Model(dict):
 
     @classmethod
     def create_all(cls,bind=None, tables=None, checkfirst=True):
-        sqls = cls.sqls
-        check_sqls = cls.check_sqls
-        if checkfirst:
-            sqls = check_sqls
-        if tables is not None:
-            for table in tables:
-                try:
-                    sql = sqls[table]
-                except KeyError:
-                    raise TableModuleError("'table module not built' table:'%s' " %table)
-                db.update(sqls[table])
-        else:
-            for k,sql in sqls.iteritems():
-                    db.update(sql)
+        if tables is None:
+            tables = cls.tables.keys()
+        for table in tables:
+            try:
+                table_name, mappings = cls.tables[table]
+            except KeyError:
+                raise TableModuleError("'table module not built' table:'%s' " %table)
+            db.update(_gen_sql(table_name, mappings, checkfirst))
 
     def create(self):
         sql = self.__sql__()
         #print sql
         db.update(sql)
 
+    @classmethod
+    def _factory(cls, names):
+        '''
+        Row factory for db.select() that builds instances straight from
+        cursor tuples, without an intermediate db.Dict.
+        '''
+        def _make(values):
+            obj = dict.__new__(cls)
+            dict.__init__(obj, izip(names, values))
+            return obj
+        return _make
+
+    @classmethod
+    def _mapped_factory(cls, names):
+        '''
+        Like _factory() but returns objects already in the identity map and
+        adds new ones, if the identity map is enabled.
+        '''
+        make = cls._factory(names)
+        objects = _identity_ctx.objects
+        if objects is None:
+            return make
+        pk = cls.__primary_key__.name
+        def _make(values):
+            obj = make(values)
+            return objects.setdefault((cls, obj[pk]), obj)
+        return _make
+
+    def _invalidate(self, keep=False):
+        objects = _identity_ctx.objects
+        if objects is not None:
+            key = (self.__class__, dict.get(self, self.__primary_key__.name))
+            if not keep or objects.get(key) is not self:
+                objects.pop(key, None)
+
     @classmethod
     def get(cls, pk):
         '''
-        Get by primary key.
+        Get by primary key. If the identity map is enabled and already holds
+        the object, it is returned without query.
+        >>> class Item(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        >>> db.update('create table if not exists item (id bigint not null, name varchar(255) not null, primary key(id))')
+        0L
+        >>> r = Item(id=1, name='a').insert()
+        >>> Item.get(1) is Item.get(1)
+        False
+        >>> with identity_map():
+        ...     Item.get(1) is Item.get(1) is Item.find_first('where name=?', 'a')
+        True
+        '''
+        objects = _identity_ctx.objects
+        if objects is not None:
+            obj = objects.get((cls, pk))
+            if obj is not None:
+                return obj
+        return db.select_one(cls.__select_pk_sql__, pk, factory=cls._mapped_factory)
+
+    @classmethod
+    def get_async(cls, pk):
+        '''
+        Like get() but run on the adb executor and return a Future. The
+        identity map of the calling thread is checked first.
         '''
-        d = db.select_one('select * from %s where %s=?' %(cls.__table__,cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        objects = _identity_ctx.objects
+        if objects is not None:
+            obj = objects.get((cls, pk))
+            if obj is not None:
+                f = adb.Future()
+                f.set_result(obj)
+                return f
+        return adb.submit(db.select_one, cls.__select_pk_sql__, pk, factory=cls._factory)
     @classmethod
     def find_first(cls, where, *args):
         '''
         Find by where clause and return one result. If multiple results found, 
         only the first one returned. If no result found, return None.
         '''
-        d = db.select_one('select * from %s %s' %(cls.__table__,where), *args)
-        return cls(**d) if d else None
+        return db.select_one('%s %s' %(cls.__select_sql__,where), *args, factory=cls._mapped_factory)
     @classmethod
     def find_all(cls, *args):
         '''
         find all and return list.
         '''
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+        return db.select(cls.__select_sql__, factory=cls._mapped_factory)
 
     @classmethod
     def find_by(cls, where, *args):
         '''
         find by where clause and return list.
         '''
-        L = db.select('select * from %s %s' %(cls.__table__,where), *args)
-        return [cls(**d) for d in L]
+        return db.select('%s %s' %(cls.__select_sql__,where), *args, factory=cls._mapped_factory)
+    @classmethod
+    def find_by_async(cls, where, *args):
+        '''
+        Like find_by() but run on the adb executor and return a Future.
+        '''
+        return adb.select('%s %s' %(cls.__select_sql__,where), *args, factory=cls._factory)
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        '''
+        find by where clause and return a generator. Rows are streamed from
+        the database, pass batch_size to tune how many are fetched at a time.
+        '''
+        kw['factory'] = cls._factory
+        return db.select_iter('%s %s' % (cls.__select_sql__, where), *args, **kw)
+
     @classmethod
     def count_all(cls):
         '''
         Find by 'select count(pk) from table' and return integer.
         '''
-        return db.select_int('select count(`%s`) from `%s`' %(cls._primary_key__.name,cls__table__))
+        return db.select_int(cls.__count_sql__)
     @classmethod
     def count_by(cls,where,*args):
         '''
         Find by 'select count(pk) from table where ... ' and return int.
         '''
-        return db.select_int('select count(`%s`) from `%s` %s' %(cls.__primary_key__.name,cls.__table__,where),*args)
+        return db.select_int('%s %s' %(cls.__count_sql__,where),*args)
     
 
+    def _values(self, fields):
+        args = []
+        for k,v in fields:
+            if not k in self:
+                self[k] = v.default
+            args.append(self[k])
+        return args
+
     def update(self):
+        '''
+        Write back updatable attributes modified since load or last save.
+        Nothing is sent to the database if no such attribute changed.
+        '''
         self.pre_update and self.pre_update()
-        L = []
-        args = []
-        for k,v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self,k):
-                    arg = getattr(self,k)
-                else:
-                    arg = v.default
-                    setattr(self,k,args)
-                L.append('`%s`=?' %k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self,pk))
-        db.update('update `%s` set %s where %s=?' %(self.__table__,','.join(L),pk), *args)
+        dirty = self._dirty
+        fields = [(k, v) for k, v in self.__update_fields__ if k in dirty]
+        if fields:
+            key = tuple([k for k, v in fields])
+            sql = self.__update_sqls__.get(key)
+            if sql is None:
+                sql = self.__update_sqls__[key] = _update_sql(self.__table__, fields, self.__primary_key__.name)
+            args = [self[k] for k in key]
+            args.append(self[self.__primary_key__.name])
+            db.update(sql, *args)
+            self._invalidate(keep=True)
+            _notify(self, 'post_update', key)
+        self._clean()
         return self
     def delete(self):
         self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self,pk),)
-        db.update('delete from `%s` where `%s`=?' %(self.__table__,pk),*args)
+        db.update(self.__delete_sql__, self[self.__primary_key__.name])
+        self._invalidate()
+        _notify(self, 'post_delete')
         return self
 
-    def insert(self):
+    def _insert_args(self):
         self.pre_insert and self.pre_insert()
-        params = {}
-        for k,v in self.__mappings__.iteritems():
-            logger.info("***************%s:%s" % (k,v))
-            if v.insertable:
-                if not hasattr(self,k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self,k)
-        db.insert('%s' %self.__table__,**params)
+        return self._values(self.__insert_fields__)
+
+    def insert(self):
+        db.update(self.__insert_sql__, *self._insert_args())
+        self._clean()
+        _notify(self, 'post_insert')
         return self
 
+    def insert_async(self):
+        '''
+        Like insert() but run on the adb executor and return a Future of
+        self. pre_insert runs at once in the calling thread, post_insert
+        listeners run on the executor thread after the insert.
+        '''
+        args = self._insert_args()
+        def _insert():
+            db.update(self.__insert_sql__, *args)
+            self._clean()
+            _notify(self, 'post_insert')
+            return self
+        return adb.submit(_insert)
+
+    @classmethod
+    def insert_all(cls, objs):
+        '''
+        Insert many objects with one bulk insert committed once.
+        pre_insert hooks and default values are applied to each object first.
+        '''
+        L = list(objs)
+        if not L:
+            return L
+        db.update_many(cls.__insert_sql__, [obj._insert_args() for obj in L])
+        for obj in L:
+            obj._clean()
+            _notify(obj, 'post_insert')
+        return L
+
 
 if __name__=='__main__':
     import sys
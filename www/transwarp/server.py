@@ -0,0 +1,781 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Pre-fork and thread pool WSGI servers.
+
+The master binds the listening socket once and forks worker processes that
+accept on it. Workers that exit are respawned. SIGHUP replaces all workers
+gracefully, SIGTERM and SIGINT stop the server.
+
+    server = PreforkServer(wsgi_app, '0.0.0.0', 9000, workers=4, max_requests=10000)
+    server.serve_forever()
+
+ThreadPoolServer serves HTTP/1.1 keep-alive connections by a fixed number of
+threads, in one process or in each pre-fork worker:
+
+    server = ThreadPoolServer(wsgi_app, '0.0.0.0', 9000, threads=16)
+    server.serve_forever()
+
+EventLoopServer runs the same thread pool, but idle keep-alive connections
+and clients still sending request headers wait in a poll() loop instead of
+holding a thread, so thousands of them cost only a file descriptor each.
+'''
+
+import os, time, fcntl, errno, select, signal, socket, logging, threading, collections, multiprocessing, Queue
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+logger = logging.getLogger(__name__)
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class _WorkerServer(WSGIServer):
+    '''
+    WSGIServer accepting on a socket inherited from master.
+    '''
+    def __init__(self, sock, app):
+        WSGIServer.__init__(self, sock.getsockname()[:2], WSGIRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.handled = 0
+
+    def finish_request(self, request, client_address):
+        self.handled = self.handled + 1
+        WSGIServer.finish_request(self, request, client_address)
+
+def _bind(address, backlog):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    # all workers wake up on a new connection but only one gets it, so
+    # accept must fail fast for the others. The socket object itself
+    # stays in blocking mode so select() in handle_request() still waits:
+    flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFL)
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return sock
+
+# request line and headers larger than this are not buffered any further:
+_MAX_HEADERS = 65536 + 8192
+# unread request body up to this size is drained to keep the connection alive:
+_MAX_DRAIN = 64 * 1024
+# bytes read from a client before closing, so it gets the response and not RST:
+_MAX_LINGER = 1024 * 1024
+
+class _Input(object):
+    '''
+    wsgi.input reading at most Content-Length bytes of the connection, so
+    what the application leaves unread can be drained afterwards.
+    >>> from StringIO import StringIO
+    >>> i = _Input(StringIO('a=1&b=2GET / HTTP/1.1'), 7)
+    >>> i.read(3), i.remaining
+    ('a=1', 4)
+    >>> i.drain(_MAX_DRAIN), i.read()
+    (True, '')
+    '''
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size) if size else ''
+        self.remaining = self.remaining - len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self._rfile.readline(size) if size else ''
+        self.remaining = self.remaining - len(line)
+        return line
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def drain(self, limit):
+        '''
+        Read and discard the rest of the body if it is at most limit bytes.
+        Return False if the body is larger or the client stopped sending.
+        '''
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(min(self.remaining, 8192)):
+                return False
+        return True
+
+def _drain_socket(conn, limit, timeout):
+    # read what the client sends until it closes, up to limit bytes:
+    deadline = time.time() + timeout
+    while limit > 0:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        conn.settimeout(remaining)
+        data = conn.recv(min(limit, 8192))
+        if not data:
+            return
+        limit = limit - len(data)
+
+def _lingering_close(conn):
+    '''
+    Close the sending side and read what the client still sends for up to a
+    second. Closing with unread data would send RST, and the client could
+    lose the response before reading it.
+    '''
+    try:
+        conn.shutdown(socket.SHUT_WR)
+        _drain_socket(conn, _MAX_LINGER, 1)
+    except socket.error:
+        pass
+
+class _Closer(object):
+    '''
+    Lingering close of sockets in a background thread, so a rejected client
+    does not hold up the thread accepting connections. Each socket is read
+    without blocking until the client closes it, limit bytes are read or
+    timeout seconds are passed.
+    '''
+    def __init__(self, limit=_MAX_LINGER, timeout=1, max_sockets=1024):
+        self.limit = limit
+        self.timeout = timeout
+        self.max_sockets = max_sockets
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._count = 0
+        self._wakeup = None
+
+    def close(self, conn):
+        try:
+            conn.shutdown(socket.SHUT_WR)
+        except socket.error:
+            conn.close()
+            return
+        with self._lock:
+            if self._count >= self.max_sockets:
+                conn.close()
+                return
+            self._count = self._count + 1
+            if self._wakeup is None:
+                self._wakeup = os.pipe()
+                for fd in self._wakeup:
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                t = threading.Thread(target=self._run, name='closer')
+                t.daemon = True
+                t.start()
+        self._pending.append(conn)
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _close(self, poller, socks, fd):
+        poller.unregister(fd)
+        conn = socks.pop(fd)[0]
+        try:
+            conn.close()
+        except socket.error:
+            pass
+        with self._lock:
+            self._count = self._count - 1
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._wakeup[0], select.POLLIN)
+        # fd -> [socket, deadline, bytes left to read]:
+        socks = {}
+        while True:
+            timeout = None
+            if socks:
+                timeout = max(0, min([item[1] for item in socks.itervalues()]) - time.time()) * 1000
+            try:
+                events = poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeup[0]:
+                    try:
+                        os.read(fd, 4096)
+                    except OSError:
+                        pass
+                    continue
+                item = socks[fd]
+                try:
+                    data = item[0].recv(8192)
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        continue
+                    data = ''
+                item[2] = item[2] - len(data)
+                if not data or item[2] <= 0:
+                    self._close(poller, socks, fd)
+            while self._pending:
+                conn = self._pending.popleft()
+                conn.setblocking(0)
+                socks[conn.fileno()] = [conn, time.time() + self.timeout, self.limit]
+                poller.register(conn.fileno(), select.POLLIN)
+            now = time.time()
+            for fd in [fd for fd, item in socks.iteritems() if item[1] <= now]:
+                self._close(poller, socks, fd)
+
+_BODY_503 = '<html><body><h1>503 Service Unavailable</h1></body></html>'
+_RESPONSE_503 = 'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/html\r\nContent-Length: %d\r\nRetry-After: 1\r\nConnection: close\r\n\r\n%s' % (len(_BODY_503), _BODY_503)
+
+class _KeepAliveServerHandler(ServerHandler):
+    '''
+    ServerHandler speaking HTTP/1.1. A response without Content-Length is
+    sent chunked to HTTP/1.1 clients, so the connection can be kept alive.
+    '''
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        self.chunked = False
+        if not 'Content-Length' in self.headers and request_handler.request_version == 'HTTP/1.1' and not self.status[:3] in ('204', '304'):
+            self.chunked = True
+            self.headers['Transfer-Encoding'] = 'chunked'
+        # a request body left unread by the application is drained later,
+        # unless it is too large or its length is unknown:
+        drainable = self.stdin.remaining <= _MAX_DRAIN and not request_handler.headers.get('Transfer-Encoding')
+        server = request_handler.server
+        self.keep_alive = server.keep_alive and server.running and not request_handler.close_connection and drainable and ('Content-Length' in self.headers or self.chunked)
+        if not self.keep_alive:
+            self.headers['Connection'] = 'close'
+        elif request_handler.request_version != 'HTTP/1.1':
+            self.headers['Connection'] = 'keep-alive'
+
+    def write(self, data):
+        if not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent = self.bytes_sent + len(data)
+        if not self.chunked:
+            self._write(data)
+        elif data:
+            self._write('%x\r\n%s\r\n' % (len(data), data))
+        self._flush()
+
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        if self.chunked:
+            self._write('0\r\n\r\n')
+            self._flush()
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    '''
+    Serve requests on one connection until the client or the response asks
+    to close it, or the connection is idle for keep_alive seconds.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.handle_one_request()
+        while not self.close_connection and self._wait_request():
+            self.handle_one_request()
+
+    def _wait_request(self):
+        # a pipelined request may be read into buffer already:
+        if self.rfile._rbuf.tell():
+            return True
+        r, w, e = select.select([self.connection], [], [], self.server.keep_alive)
+        return bool(r)
+
+    def handle_one_request(self):
+        self.close_connection = 1
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        environ = self.get_environ()
+        try:
+            length = max(0, int(environ.get('CONTENT_LENGTH') or 0))
+        except ValueError:
+            length = 0
+            self.close_connection = 1
+        stdin = _Input(self.rfile, length)
+        handler = _KeepAliveServerHandler(stdin, self.wfile, self.get_stderr(), environ)
+        handler.request_handler = self
+        handler.keep_alive = False
+        handler.run(self.server.get_app())
+        self.server.count()
+        if not handler.keep_alive or not stdin.drain(_MAX_DRAIN):
+            self.close_connection = 1
+            if stdin.remaining:
+                _lingering_close(self.connection)
+
+class ThreadPoolServer(object):
+
+    def __init__(self, app, host='127.0.0.1', port=9000, threads=10, queue_size=None, timeout=30, keep_alive=5, max_requests=0, backlog=128, sock=None):
+        '''
+        Init a thread pool server.
+        Args:
+          app: wsgi application.
+          threads: number of threads handling connections.
+          queue_size: accepted connections waiting for a thread, more get 503 at once, default to threads * 2.
+          timeout: socket timeout in seconds of reading a request and writing a response.
+          keep_alive: seconds to keep an idle connection open, 0 to close after each response.
+          max_requests: stop after this many requests, 0 for never.
+          sock: listening socket to use instead of binding host and port.
+        '''
+        self.app = app
+        self.threads = threads
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.max_requests = max_requests
+        self.running = False
+        self.handled = 0
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(queue_size or threads * 2)
+        self._closer = _Closer()
+        self._sock = sock or _bind((host, port), backlog)
+        host, port = self._sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.base_environ = dict(SERVER_NAME=self.server_name, GATEWAY_INTERFACE='CGI/1.1', SERVER_PORT=str(port), REMOTE_HOST='', CONTENT_LENGTH='', SCRIPT_NAME='')
+
+    def get_app(self):
+        return self.app
+
+    def count(self):
+        with self._lock:
+            self.handled = self.handled + 1
+            if self.max_requests and self.handled >= self.max_requests:
+                self.running = False
+
+    def stop(self):
+        '''
+        Stop accepting, connections already accepted are still served.
+        '''
+        self.running = False
+
+    def _start_threads(self):
+        self.running = True
+        threads = [threading.Thread(target=self._work, name='worker-%d' % n) for n in range(self.threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        logger.info('%d threads serving at %s:%s...' % (self.threads, self.server_name, self.server_port))
+        return threads
+
+    def _stop_threads(self, threads):
+        self.running = False
+        for t in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join()
+
+    def serve_forever(self, poll_interval=1):
+        threads = self._start_threads()
+        try:
+            while self.running:
+                try:
+                    r, w, e = select.select([self._sock], [], [], poll_interval)
+                    if not r:
+                        continue
+                    conn, addr = self._sock.accept()
+                except (select.error, socket.error), e:
+                    if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                        continue
+                    raise
+                try:
+                    self._queue.put_nowait((conn, addr))
+                except Queue.Full:
+                    self._reject(conn)
+        finally:
+            # refuse connections at once instead of leaving them in the backlog:
+            self._sock.close()
+            self._stop_threads(threads)
+
+    def _reject(self, conn):
+        '''
+        Answer 503 without blocking the calling thread. The response is small
+        enough for the socket buffer of a new connection, and the connection
+        is closed by the closer thread.
+        '''
+        logger.warning('too many pending connections, return 503.')
+        try:
+            conn.setblocking(0)
+            conn.send(_RESPONSE_503)
+        except socket.error:
+            conn.close()
+            return
+        self._closer.close(conn)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            conn, addr = item
+            try:
+                conn.settimeout(self.timeout)
+                _KeepAliveRequestHandler(conn, addr, self)
+            except socket.timeout:
+                pass
+            except socket.error, e:
+                logger.info('connection from %s closed: %s' % (addr[0], e))
+            except Exception, e:
+                logger.exception(e)
+            finally:
+                try:
+                    conn.close()
+                except socket.error:
+                    pass
+
+class _Connection(_KeepAliveRequestHandler):
+    '''
+    Keep-alive connection of EventLoopServer, handling one request at a
+    time on whatever thread it is dispatched to.
+    '''
+    def __init__(self, sock, addr, server):
+        self.request = sock
+        self.client_address = addr
+        self.server = server
+        self.timeout = server.timeout
+        self.setup()
+        self.close_connection = 0
+        self.last_active = time.time()
+
+    def buffered(self):
+        return self.rfile._rbuf.tell() > 0
+
+    def pending(self):
+        '''
+        Whether the request line and headers of the next request are read
+        into buffer already, so handling it will not wait for the client.
+        Overlong headers count as complete, to be rejected by the handler.
+        '''
+        data = self.rfile._rbuf.getvalue()
+        return '\r\n\r\n' in data or '\n\n' in data or len(data) > _MAX_HEADERS
+
+    def fill(self):
+        '''
+        Read what the client has sent into buffer, call only when the socket
+        is readable. Return False if the client closed the connection.
+        '''
+        try:
+            data = self.connection.recv(8192)
+        except socket.error:
+            return False
+        if not data:
+            return False
+        rbuf = self.rfile._rbuf
+        rbuf.seek(0, 2)
+        rbuf.write(data)
+        return True
+
+    def close(self):
+        try:
+            self.finish()
+        except socket.error:
+            pass
+        try:
+            self.connection.close()
+        except socket.error:
+            pass
+
+class EventLoopServer(ThreadPoolServer):
+    '''
+    Thread pool server whose idle connections are parked in a poll() loop.
+    The loop reads the request line and headers, and a connection is
+    dispatched to the pool only when they are complete, so neither idle nor
+    slowly sending clients hold a thread. It goes back to the loop after the
+    response. The request body is read by the thread.
+    '''
+
+    def _park(self, conn):
+        conn.last_active = time.time()
+        self._returned.append(conn)
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def serve_forever(self, poll_interval=1):
+        # connections returned by threads, and a pipe to wake up the loop:
+        self._returned = collections.deque()
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        poller = select.poll()
+        poller.register(self._sock.fileno(), select.POLLIN)
+        poller.register(self._wakeup[0], select.POLLIN)
+        # fd -> parked connection:
+        parked = {}
+        swept_at = time.time()
+        threads = self._start_threads()
+        try:
+            while self.running:
+                try:
+                    events = poller.poll(poll_interval * 1000)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd == self._sock.fileno():
+                        self._accept(poller, parked)
+                    elif fd == self._wakeup[0]:
+                        try:
+                            os.read(fd, 4096)
+                        except OSError:
+                            pass
+                    else:
+                        conn = parked[fd]
+                        if not conn.buffered():
+                            # the request read timeout starts with its first byte:
+                            conn.last_active = time.time()
+                        if not conn.fill():
+                            poller.unregister(fd)
+                            del parked[fd]
+                            conn.close()
+                        elif conn.pending():
+                            poller.unregister(fd)
+                            del parked[fd]
+                            self._dispatch(conn)
+                while self._returned:
+                    conn = self._returned.popleft()
+                    parked[conn.connection.fileno()] = conn
+                    poller.register(conn.connection.fileno(), select.POLLIN)
+                now = time.time()
+                if now - swept_at >= 1:
+                    swept_at = now
+                    for fd, conn in parked.items():
+                        if now - conn.last_active > (self.timeout if conn.buffered() else self.keep_alive):
+                            poller.unregister(fd)
+                            del parked[fd]
+                            conn.close()
+        finally:
+            self._sock.close()
+            self._stop_threads(threads)
+            for conn in parked.itervalues():
+                conn.close()
+            for conn in self._returned:
+                conn.close()
+            for fd in self._wakeup:
+                os.close(fd)
+
+    def _accept(self, poller, parked):
+        while True:
+            try:
+                sock, addr = self._sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            sock.settimeout(self.timeout)
+            conn = _Connection(sock, addr, self)
+            parked[sock.fileno()] = conn
+            poller.register(sock.fileno(), select.POLLIN)
+
+    def _dispatch(self, conn):
+        try:
+            self._queue.put_nowait((conn, None))
+        except Queue.Full:
+            conn.finish()
+            self._reject(conn.connection)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            conn = item[0]
+            try:
+                conn.handle_one_request()
+                while not conn.close_connection and self.running and conn.pending():
+                    conn.handle_one_request()
+            except socket.timeout:
+                conn.close_connection = 1
+            except socket.error, e:
+                logger.info('connection from %s closed: %s' % (conn.client_address[0], e))
+                conn.close_connection = 1
+            except Exception, e:
+                logger.exception(e)
+                conn.close_connection = 1
+            if conn.close_connection or not self.running:
+                conn.close()
+            else:
+                self._park(conn)
+
+class PreforkServer(object):
+
+    def __init__(self, app, host='127.0.0.1', port=9000, workers=None, max_requests=0, graceful_timeout=30, backlog=128, threads=0, **thread_kw):
+        '''
+        Init a pre-fork server.
+        Args:
+          app: wsgi application.
+          workers: number of worker processes, default to CPU count.
+          max_requests: a worker exits and is replaced after this many requests, 0 for never.
+          graceful_timeout: seconds to wait for workers finishing requests before killing them.
+          threads: run a ThreadPoolServer with this many threads in each worker, 0 for one request at a time.
+          thread_kw: other arguments of ThreadPoolServer, and event_loop=True to use EventLoopServer.
+        '''
+        self.app = app
+        self.address = (host, port)
+        self.workers = workers or cpu_count()
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.threads = threads
+        self.server_class = EventLoopServer if thread_kw.pop('event_loop', False) else ThreadPoolServer
+        self.thread_kw = thread_kw
+        self._sock = None
+        # pid -> generation of running workers:
+        self._workers = {}
+        self._generation = 0
+        self._signals = []
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def serve_forever(self):
+        self._sock = _bind(self.address, self.backlog)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+        logger.info('master %d listening at %s:%s with %d workers...' % (os.getpid(), self.address[0], self.address[1], self.workers))
+        try:
+            self._spawn_workers()
+            while True:
+                self._reap_workers()
+                if self._signals:
+                    signum = self._signals.pop(0)
+                    if signum in (signal.SIGTERM, signal.SIGINT):
+                        logger.info('master stopping...')
+                        break
+                    if signum == signal.SIGHUP:
+                        self._reload()
+                    continue
+                self._spawn_workers()
+                # woken up early by signals:
+                time.sleep(1)
+        finally:
+            self._stop_workers()
+            self._sock.close()
+
+    def _spawn_workers(self):
+        while len([g for g in self._workers.itervalues() if g == self._generation]) < self.workers:
+            self._spawn_worker()
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = self._generation
+            return
+        # in worker:
+        code = 0
+        try:
+            self._worker_loop()
+        except Exception, e:
+            logger.exception(e)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if self._workers.pop(pid, None) is not None:
+                logger.info('worker %d exited with status %d.' % (pid, status))
+
+    def _reload(self):
+        '''
+        Start a new generation of workers, then let the old ones finish their
+        current request and exit.
+        '''
+        logger.info('master reloading workers...')
+        old = [pid for pid, g in self._workers.iteritems() if g == self._generation]
+        self._generation = self._generation + 1
+        self._spawn_workers()
+        self._kill(old, signal.SIGTERM)
+
+    def _kill(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _stop_workers(self):
+        self._kill(self._workers.keys(), signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self._workers and time.time() < deadline:
+            self._reap_workers()
+            time.sleep(0.1)
+        self._kill(self._workers.keys(), signal.SIGKILL)
+        self._reap_workers()
+
+    def _worker_loop(self):
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # master handles Ctrl-C:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.threads:
+            server = self.server_class(self.app, threads=self.threads, max_requests=self.max_requests, sock=self._sock, **self.thread_kw)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            logger.info('worker %d started.' % os.getpid())
+            server.serve_forever()
+            if self.max_requests and server.handled >= self.max_requests:
+                logger.info('worker %d handled %d requests, recycling...' % (os.getpid(), server.handled))
+            return
+        alive = [True]
+        def _stop(signum, frame):
+            alive[0] = False
+        signal.signal(signal.SIGTERM, _stop)
+        server = _WorkerServer(self._sock, self.app)
+        # wake up regularly to check whether to stop:
+        server.timeout = 1
+        logger.info('worker %d started.' % os.getpid())
+        ppid = os.getppid()
+        while alive[0] and os.getppid() == ppid:
+            try:
+                server.handle_request()
+            except (select.error, socket.error), e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            if self.max_requests and server.handled >= self.max_requests:
+                logger.info('worker %d handled %d requests, recycling...' % (os.getpid(), server.handled))
+                break
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -7,7 +7,11 @@ A simple, lightweight, WSGI-compatible web framework.
 
 __author__ = 'copy from Michael Liao'
 
-import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, urllib, traceback
+import types, os, re, cgi, sys, json, stat, time, zlib, hashlib, tempfile, datetime, functools, mimetypes, threading, logging, urllib, urlparse, traceback
+
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -329,6 +333,19 @@ def notfound():
     '''
     return HttpError(404)
 
+def methodnotallowed(allowed):
+    '''
+    Send a method not allowed response with the allowed methods.
+    >>> e = methodnotallowed(['POST', 'GET'])
+    >>> e.status
+    '405 Method Not Allowed'
+    >>> e.headers
+    [('X-Powered-By', 'transwarp/1.0'), ('Allow', 'GET, POST')]
+    '''
+    e = HttpError(405)
+    e.header('Allow', ', '.join(sorted(allowed)))
+    return e
+
 def conflict():
     '''
     Send a conflict response.
@@ -534,33 +551,559 @@ class Route(object):
 
     __repr__ = __str__
 
-def _static_file_generator(fpath):
-    BLOCK_SIZE = 8192
-    with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+_re_route_param = re.compile(r'^\:[a-zA-Z_]\w*$')
+
+class _RouteNode(object):
+    '''
+    A node of the route trie for one path segment.
+    '''
+    __slots__ = ('children', 'patterns', 'param', 'routes', 'mount')
+
+    def __init__(self):
+        # static segment -> node:
+        self.children = {}
+        # (compiled regex, regex source, node) for segments like ':id-:pid':
+        self.patterns = []
+        # node for a segment that is a single ':param':
+        self.param = None
+        # method -> route:
+        self.routes = {}
+        # route serving every path below this node, e.g. '/static/':
+        self.mount = None
+
+class Router(object):
+    '''
+    Segment trie built once from all routes. Each path segment is matched as
+    static segment first, then mixed segments like ':id-:pid' in registration
+    order, then a ':param' segment, with backtracking. Prefix mounts only
+    match if no route does.
+    >>> def _route(method, path):
+    ...     fn = lambda *args: (path, args)
+    ...     fn.__web_route__ = path
+    ...     fn.__web_method__ = method
+    ...     return Route(fn)
+    >>> router = Router()
+    >>> for m, p in [('GET', '/'), ('GET', '/blog/:id'), ('GET', '/blog/new'), ('POST', '/blog/:id'), ('GET', '/:user/list'), ('GET', '/file/:name-:ext')]:
+    ...     router.add(_route(m, p))
+    >>> router.mount(StaticFileRoute())
+    >>> def call(method, path):
+    ...     route, args = router.match(method, path)
+    ...     return route(*args)
+    >>> call('GET', '/')
+    ('/', ())
+    >>> call('GET', '/blog/new')
+    ('/blog/new', ())
+    >>> call('GET', '/blog/123')
+    ('/blog/:id', ('123',))
+    >>> call('POST', '/blog/new')
+    ('/blog/:id', ('new',))
+    >>> call('GET', '/blog/list')
+    ('/blog/:id', ('list',))
+    >>> call('GET', '/alice/list')
+    ('/:user/list', ('alice',))
+    >>> call('GET', '/file/a-b.txt')
+    ('/file/:name-:ext', ('a', 'b.txt'))
+    >>> router.match('GET', '/static/css/a.css')
+    (StaticFileRoute(/static/), ('static/css/a.css',))
+    >>> router.match('GET', '/blog/')
+    Traceback (most recent call last):
+      ...
+    HttpError: 404 Not Found
+    >>> router.match('DELETE', '/blog/123')
+    Traceback (most recent call last):
+      ...
+    HttpError: 405 Method Not Allowed
+    '''
+
+    def __init__(self):
+        self._root = _RouteNode()
+        # (method, path) -> route for paths without params, always matched first:
+        self._static = {}
+
+    def _node(self, segments):
+        node = self._root
+        for seg in segments:
+            if not ':' in seg:
+                child = node.children.get(seg)
+                if child is None:
+                    child = node.children[seg] = _RouteNode()
+            elif _re_route_param.match(seg):
+                child = node.param
+                if child is None:
+                    child = node.param = _RouteNode()
+            else:
+                source = _build_regex(seg)
+                for regex, src, child in node.patterns:
+                    if src == source:
+                        break
+                else:
+                    child = _RouteNode()
+                    node.patterns.append((re.compile(source), source, child))
+            node = child
+        return node
+
+    def add(self, route):
+        node = self._node(route.path.split('/'))
+        if route.method in node.routes:
+            logger.warning('Redefine route: %s' % str(route))
+        node.routes[route.method] = route
+        if route.is_static:
+            self._static[(route.method, route.path)] = route
+
+    def routes(self):
+        '''
+        Return all routes and mounts in the trie.
+        '''
+        L = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            L.extend(node.routes.itervalues())
+            if node.mount is not None:
+                L.append(node.mount)
+            nodes.extend(node.children.itervalues())
+            nodes.extend([child for regex, source, child in node.patterns])
+            if node.param is not None:
+                nodes.append(node.param)
+        return L
+
+    def mount(self, route):
+        '''
+        Mount a route with prefix and match(path) attributes for all paths below prefix.
+        '''
+        segments = route.prefix.split('/')
+        if segments[-1] == '':
+            segments.pop()
+        self._node(segments).mount = route
+
+    def _walk(self, node, segments, i, args, method, allowed):
+        if i == len(segments):
+            route = node.routes.get(method)
+            if route is not None:
+                return route, args
+            allowed.update(node.routes)
+            return None
+        seg = segments[i]
+        child = node.children.get(seg)
+        if child is not None:
+            r = self._walk(child, segments, i + 1, args, method, allowed)
+            if r:
+                return r
+        for regex, source, child in node.patterns:
+            m = regex.match(seg)
+            if m:
+                r = self._walk(child, segments, i + 1, args + m.groups(), method, allowed)
+                if r:
+                    return r
+        if node.param is not None and seg:
+            return self._walk(node.param, segments, i + 1, args + (seg,), method, allowed)
+        return None
+
+    def match(self, method, path):
+        '''
+        Return (route, args) for request method and path. Raise 404 if no
+        route matches the path, or 405 if routes match but none for method.
+        '''
+        route = self._static.get((method, path))
+        if route is not None:
+            return route, ()
+        segments = path.split('/')
+        allowed = set()
+        r = self._walk(self._root, segments, 0, (), method, allowed)
+        if r:
+            return r
+        node = self._root
+        mount = None
+        for i, seg in enumerate(segments[:-1]):
+            node = node.children.get(seg)
+            if node is None:
+                break
+            if node.mount is not None:
+                mount = node.mount
+        if mount is not None:
+            if mount.method == method:
+                return mount, mount.match(path)
+            allowed.add(mount.method)
+        if allowed:
+            raise methodnotallowed(allowed)
+        raise notfound()
+
+def _block_size(size):
+    '''
+    Read block size for a file of given size, between 8 KB and 256 KB.
+    >>> _block_size(1000)
+    8192
+    >>> _block_size(1024 * 1024)
+    131072
+    >>> _block_size(100 * 1024 * 1024)
+    262144
+    '''
+    return max(8192, min(size // 8, 262144))
+
+def _static_file_generator(f, block_size=8192, length=None):
+    try:
+        remaining = length
+        while remaining is None or remaining > 0:
+            block = f.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining = remaining - len(block)
             yield block
-            block = f.read(BLOCK_SIZE)
+    finally:
+        f.close()
+
+def _parse_range(value, size):
+    '''
+    Parse a single byte range as (start, end) inclusive. Return None if header
+    should be ignored, or raise 416 if range is not satisfiable.
+    >>> _parse_range('bytes=0-99', 1000)
+    (0, 99)
+    >>> _parse_range('bytes=900-2000', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=0-1,5-6', 1000)
+    >>> _parse_range('items=0-1', 1000)
+    >>> _parse_range('bytes=1000-', 1000)
+    Traceback (most recent call last):
+      ...
+    HttpError: 416 Requested Range Not Satisfiable
+    '''
+    value = value.strip()
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    start, sep, end = value[6:].partition('-')
+    try:
+        start = int(start) if start.strip() else None
+        end = int(end) if end.strip() else None
+    except ValueError:
+        return None
+    if not sep or (start is None and end is None):
+        return None
+    if start is None:
+        if end == 0:
+            raise HttpError(416)
+        return max(0, size - end), size - 1
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        raise HttpError(416)
+    return start, size - 1 if end is None else min(end, size - 1)
+
+_COMPRESSIBLE_TYPES = frozenset(['application/javascript', 'application/x-javascript', 'application/json', 'application/xml', 'image/svg+xml', 'application/vnd.ms-fontobject', 'font/ttf', 'application/x-font-ttf'])
+
+def _compressible(content_type):
+    '''
+    Check if content type is worth to compress. Images, fonts like woff and
+    archives are compressed already.
+    >>> _compressible('text/html; charset=utf-8')
+    True
+    >>> _compressible('application/json')
+    True
+    >>> _compressible('image/png')
+    False
+    '''
+    if not content_type:
+        return False
+    ct = content_type.split(';', 1)[0].strip().lower()
+    return ct.startswith('text/') or ct in _COMPRESSIBLE_TYPES
+
+def _accepts_gzip(request):
+    '''
+    Check if gzip is acceptable by Accept-Encoding header.
+    >>> _accepts_gzip(Request({'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}))
+    True
+    >>> _accepts_gzip(Request({'HTTP_ACCEPT_ENCODING': 'gzip;q=0, deflate'}))
+    False
+    >>> _accepts_gzip(Request({}))
+    False
+    >>> _accepts_gzip(Request({'HTTP_ACCEPT_ENCODING': '*;q=0, gzip'}))
+    True
+    >>> _accepts_gzip(Request({'HTTP_ACCEPT_ENCODING': 'br, *;q=0.5'}))
+    True
+    '''
+    value = request.header('Accept-Encoding')
+    if not value:
+        return False
+    # an explicit gzip entry overrides *:
+    qs = {}
+    for item in value.split(','):
+        L = item.split(';')
+        coding = L[0].strip().lower()
+        if not coding in ('gzip', 'x-gzip', '*'):
+            continue
+        q = 1.0
+        for param in L[1:]:
+            k, sep, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        qs['*' if coding == '*' else 'gzip'] = q
+    return qs.get('gzip', qs.get('*', 0.0)) > 0
+
+def _gzip(data, level=6):
+    '''
+    Compress data in gzip format.
+    >>> import gzip
+    >>> gzip.GzipFile(fileobj=StringIO(_gzip('hello' * 100))).read() == 'hello' * 100
+    True
+    '''
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+def _gzip_stream(chunks, level=6):
+    '''
+    Compress chunks in gzip format, flush after each chunk.
+    >>> import gzip
+    >>> gzip.GzipFile(fileobj=StringIO(''.join(_gzip_stream(['hello', 'world'])))).read()
+    'helloworld'
+    '''
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data + c.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            yield c.flush(zlib.Z_SYNC_FLUSH)
+    yield c.flush()
+
+# fingerprinted asset name such as app.3f2a9c1e.js:
+_RE_FINGERPRINT = re.compile(r'[\.\-][0-9a-fA-F]{8,}\.\w+$')
+
+class _Asset(object):
+    '''
+    Static file held in memory, with its precompressed variant. Content is
+    copied rather than memory mapped, as a mapped file rewritten in place
+    while being sent would crash the worker with SIGBUS.
+    '''
+    __slots__ = ('mtime', 'size', 'content_type', 'compressible', 'etag', 'last_modified', 'data', 'gz_data', 'gz_etag', 'weight')
 
 class StaticFileRoute(object):
+    '''
+    Serve files under document_root/static. Use wsgi.file_wrapper if server
+    provides one so the file can be sent by sendfile.
+    Responses carry ETag and Last-Modified, conditional requests get 304 and
+    a single byte range gets 206. Fingerprinted assets are cached as immutable
+    for fingerprint_max_age seconds, others for max_age seconds.
+    With cache_size in bytes, files are kept in memory in a LRU cache and reloaded when mtime or size changes.
+    '''
 
-    def __init__(self):
+    def __init__(self, max_age=3600, fingerprint_max_age=31536000, cache_size=0):
         self.method = 'GET'
         self.is_static = False
+        self.prefix = '/static/'
         self.route = re.compile('^/static/(.+)$')
+        self.max_age = max_age
+        self.fingerprint_max_age = fingerprint_max_age
+        # document_root -> real path of static dir:
+        self._roots = {}
+        # file path -> (mtime, size, etag, last_modified):
+        self._validators = {}
+        # file path -> _Asset:
+        self._assets = LRUCache(maxsize=sys.maxint, maxweight=cache_size) if cache_size else None
+
+    def _get_validators(self, fpath, st):
+        v = self._validators.get(fpath)
+        if v is None or v[0] != st.st_mtime or v[1] != st.st_size:
+            etag = '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+            v = self._validators[fpath] = (st.st_mtime, st.st_size, etag, formatdate(st.st_mtime, usegmt=True))
+        return v[2], v[3]
+
+    def _cache_control(self, fpath):
+        if _RE_FINGERPRINT.search(fpath):
+            return 'public, max-age=%d, immutable' % self.fingerprint_max_age
+        return 'public, max-age=%d' % self.max_age
+
+    def _set_headers(self, fpath, etag, last_modified):
+        response = ctx.response
+        response.set_header('ETag', etag)
+        response.set_header('Last-Modified', last_modified)
+        response.set_header('Cache-Control', self._cache_control(fpath))
+        response.set_header('Accept-Ranges', 'bytes')
+
+    def _not_modified(self, etag, mtime):
+        inm = ctx.request.header('If-None-Match')
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(',')]
+            return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+        ims = ctx.request.header('If-Modified-Since')
+        if ims:
+            t = parsedate_tz(ims)
+            return t is not None and mktime_tz(t) >= int(mtime)
+        return False
+
+    def _range(self, size, etag, last_modified):
+        value = ctx.request.header('Range')
+        if not value or ctx.request.request_method != 'GET':
+            return None
+        if_range = ctx.request.header('If-Range')
+        if if_range and if_range.strip() not in (etag, last_modified):
+            return None
+        try:
+            return _parse_range(value, size)
+        except HttpError:
+            ctx.response.set_header('Content-Range', 'bytes */%d' % size)
+            raise
+
+    def _real_path(self, path):
+        document_root = ctx.application.document_root
+        root = self._roots.get(document_root)
+        if root is None:
+            root = self._roots[document_root] = os.path.join(os.path.realpath(os.path.join(document_root, self.prefix[1:])), '')
+        fpath = os.path.realpath(os.path.join(document_root, path))
+        if not fpath.startswith(root):
+            raise notfound()
+        return fpath
 
     def match(self, url):
-        if url.startswith('/static/'):
+        if url.startswith(self.prefix):
             return (url[1:], )
         return None
 
+    def __str__(self):
+        return 'StaticFileRoute(%s)' % self.prefix
+
+    __repr__ = __str__
+
+    def _open(self, fpath):
+        try:
+            f = open(fpath, 'rb')
+        except IOError:
+            return None, None
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            f.close()
+            return None, None
+        return f, st
+
+    def _open_gzip(self, fpath):
+        '''
+        Open precompressed sibling fpath.gz if it is not older than fpath.
+        '''
+        f, st = self._open(fpath + '.gz')
+        if f is not None:
+            try:
+                if os.stat(fpath).st_mtime <= st.st_mtime:
+                    return f, st
+            except OSError:
+                pass
+            f.close()
+        return None, None
+
+    def _load_asset(self, fpath, content_type):
+        f, st = self._open(fpath)
+        if f is None:
+            return None
+        asset = _Asset()
+        asset.mtime = st.st_mtime
+        asset.size = st.st_size
+        asset.content_type = content_type
+        asset.compressible = _compressible(content_type)
+        asset.etag, asset.last_modified = self._get_validators(fpath, st)
+        asset.gz_data = asset.gz_etag = None
+        with f:
+            asset.data = f.read()
+        asset.weight = st.st_size
+        if asset.compressible:
+            f, gst = self._open_gzip(fpath)
+            if f is not None:
+                with f:
+                    asset.gz_data = f.read()
+                asset.gz_etag = self._get_validators(fpath + '.gz', gst)[0]
+                asset.weight = asset.weight + gst.st_size
+        return asset
+
+    def _serve_cached(self, fpath, content_type):
+        '''
+        Serve file from asset cache. Return None if file cannot be cached.
+        '''
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        # large files would evict everything else, so they are served from disk:
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self._assets.maxweight // 8:
+            return None
+        asset = self._assets.get(fpath)
+        if asset is None or asset.mtime != st.st_mtime or asset.size != st.st_size:
+            asset = self._load_asset(fpath, content_type)
+            if asset is None:
+                return None
+            self._assets.set(fpath, asset, weight=asset.weight)
+        request, response = ctx.request, ctx.response
+        data, etag = asset.data, asset.etag
+        if asset.compressible:
+            response.set_header('Vary', 'Accept-Encoding')
+            if asset.gz_data is not None and not request.header('Range') and _accepts_gzip(request):
+                data, etag = asset.gz_data, asset.gz_etag
+                response.set_header('Content-Encoding', 'gzip')
+        self._set_headers(fpath, etag, asset.last_modified)
+        if self._not_modified(etag, asset.mtime):
+            response.status = 304
+            response.content_type = None
+            return []
+        r = self._range(asset.size, etag, asset.last_modified)
+        response.content_type = asset.content_type
+        if r is not None:
+            start, end = r
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, asset.size))
+            response.content_length = end - start + 1
+            return [data[start:end + 1]]
+        response.content_length = len(data)
+        return [data]
+
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
-            raise notfound()
+        fpath = self._real_path(args[0])
+        response = ctx.response
         fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
-        return _static_file_generator(fpath)
+        content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        if self._assets is not None:
+            r = self._serve_cached(fpath, content_type)
+            if r is not None:
+                return r
+        f = None
+        vpath = fpath
+        if _compressible(content_type):
+            response.set_header('Vary', 'Accept-Encoding')
+            if not ctx.request.header('Range') and _accepts_gzip(ctx.request):
+                f, st = self._open_gzip(fpath)
+                if f is not None:
+                    vpath = fpath + '.gz'
+                    response.set_header('Content-Encoding', 'gzip')
+        if f is None:
+            f, st = self._open(fpath)
+            if f is None:
+                raise notfound()
+        etag, last_modified = self._get_validators(vpath, st)
+        self._set_headers(fpath, etag, last_modified)
+        if self._not_modified(etag, st.st_mtime):
+            f.close()
+            response.status = 304
+            response.content_type = None
+            return []
+        try:
+            r = self._range(st.st_size, etag, last_modified)
+        except HttpError:
+            f.close()
+            raise
+        response.content_type = content_type
+        block_size = _block_size(st.st_size)
+        if r is not None:
+            start, end = r
+            f.seek(start)
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, st.st_size))
+            response.content_length = end - start + 1
+            return _static_file_generator(f, block_size, end - start + 1)
+        response.content_length = st.st_size
+        file_wrapper = ctx.request.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(f, block_size)
+        return _static_file_generator(f, block_size)
 
 def favicon_handler():
     return static_file_handler('/favicon.ico')
@@ -570,31 +1113,270 @@ class MultipartFile(object):
     Multipart file storage get from request input.
     f = ctx.request['file']
     f.filename # 'test.png'
-    f.file # file-like object
+    f.file # file-like object, spooled to disk when large
+    f.content_type # 'image/png'
+    f.size # 1024
+    f.hash # sha1 hex digest of content
+    '''
+    def __init__(self, filename, file, content_type=None, size=0, hash=None):
+        self.filename = _to_unicode(filename)
+        self.file = file
+        self.content_type = content_type
+        self.size = size
+        self.hash = hash
+
+# default limit of request body size in bytes:
+_MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# uploaded file larger than this is spooled to a temporary file:
+_SPOOL_SIZE = 256 * 1024
+
+_MULTIPART_CHUNK = 64 * 1024
+
+class _BodyReader(object):
+    '''
+    Read at most length bytes from wsgi input, raise 413 when more than max_size bytes are read.
     '''
-    def __init__(self, storage):
-        self.filename = _to_unicode(storage.filename)
-        self.file = storage.file
+    def __init__(self, fp, length, max_size):
+        self._fp = fp
+        self._remaining = length
+        self._max_size = max_size
+        self._read = 0
+
+    def readline(self, size):
+        if self._remaining is not None:
+            if self._remaining <= 0:
+                return ''
+            size = min(size, self._remaining)
+        line = self._fp.readline(size)
+        self._read = self._read + len(line)
+        if self._remaining is not None:
+            self._remaining = self._remaining - len(line)
+        if self._max_size and self._read > self._max_size:
+            raise HttpError(413)
+        return line
+
+class _PartSink(object):
+    '''
+    Collect content of one multipart part. File content is hashed while
+    streaming and spooled to disk above spool_size.
+    '''
+    def __init__(self, filename, max_size, spool_size):
+        self.filename = filename
+        self.size = 0
+        self._max_size = max_size
+        if filename is None:
+            self._buffer = []
+            self._hash = None
+        else:
+            self._buffer = tempfile.SpooledTemporaryFile(max_size=spool_size)
+            self._hash = hashlib.sha1()
+
+    def write(self, data):
+        if not data:
+            return
+        self.size = self.size + len(data)
+        if self._max_size and self.size > self._max_size:
+            raise HttpError(413)
+        if self._hash is None:
+            self._buffer.append(data)
+        else:
+            self._hash.update(data)
+            self._buffer.write(data)
+
+    def value(self, content_type):
+        if self._hash is None:
+            return _to_unicode(''.join(self._buffer))
+        self._buffer.seek(0)
+        return MultipartFile(self.filename, self._buffer, content_type, self.size, self._hash.hexdigest())
+
+def _add_input(inputs, key, value):
+    if key in inputs:
+        v = inputs[key]
+        if isinstance(v, list):
+            v.append(value)
+        else:
+            inputs[key] = [v, value]
+    else:
+        inputs[key] = value
 
 class Request(object):
     '''
     Request object for obtaining all http request information.
+    Input is parsed lazily on first access by a parser chosen by content
+    type: urlencoded, JSON or multipart. Bodies larger than max_body_size
+    are rejected with 413.
     '''
 
-    def __init__(self, environ):
+    def __init__(self, environ, max_body_size=_MAX_BODY_SIZE, max_part_size=None, spool_size=_SPOOL_SIZE):
         self._environ = environ
+        self._max_body_size = max_body_size
+        self._max_part_size = max_part_size
+        self._spool_size = spool_size
+
+    def _content_length(self):
+        s = self._environ.get('CONTENT_LENGTH')
+        if not s:
+            return None
+        try:
+            length = int(s)
+        except ValueError:
+            raise badrequest()
+        if self._max_body_size and length > self._max_body_size:
+            raise HttpError(413)
+        return length
+
+    def _read_body(self):
+        if not hasattr(self, '_body'):
+            length = self._content_length()
+            fp = self._environ['wsgi.input']
+            if length is not None:
+                body = fp.read(length)
+            elif self._max_body_size:
+                body = fp.read(self._max_body_size + 1)
+                if len(body) > self._max_body_size:
+                    raise HttpError(413)
+            else:
+                body = fp.read()
+            self._body = body
+        return self._body
+
+    def _parse_urlencoded(self, inputs, qs):
+        for k, v in urlparse.parse_qsl(qs, keep_blank_values=True):
+            _add_input(inputs, k, _to_unicode(v))
+
+    def _parse_json(self, inputs):
+        '''
+        JSON body must be an object, a list value is treated as multiple values.
+        >>> from StringIO import StringIO
+        >>> body = '{"name": "Michael", "tags": ["a", "b"], "age": 20}'
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_TYPE':'application/json; charset=utf-8', 'CONTENT_LENGTH':str(len(body)), 'wsgi.input':StringIO(body)})
+        >>> r.get('name')
+        u'Michael'
+        >>> r.gets('tags')
+        [u'a', u'b']
+        >>> r.input().age
+        20
+        '''
+        try:
+            obj = json.loads(self._read_body() or '{}')
+        except ValueError:
+            raise badrequest()
+        if not isinstance(obj, dict):
+            raise badrequest()
+        inputs.update(obj)
+
+    def _parse_multipart(self, inputs, boundary):
+        '''
+        Stream multipart body part by part, so file content never has to be
+        held in memory as a whole.
+        >>> from StringIO import StringIO
+        >>> payload = '--XyZ\\r\\nContent-Disposition: form-data; name="f"; filename="a.png"\\r\\nContent-Type: image/png\\r\\n\\r\\n' + '0123456789\\r\\n' * 10 + '\\r\\n--XyZ--\\r\\n'
+        >>> env = {'REQUEST_METHOD':'POST', 'CONTENT_LENGTH':str(len(payload)), 'CONTENT_TYPE':'multipart/form-data; boundary=XyZ'}
+        >>> env['wsgi.input'] = StringIO(payload)
+        >>> f = Request(env, spool_size=16).get('f')
+        >>> f.size, f.content_type, f.file._rolled
+        (120, 'image/png', True)
+        >>> f.hash == hashlib.sha1('0123456789\\r\\n' * 10).hexdigest()
+        True
+        >>> env['wsgi.input'] = StringIO(payload)
+        >>> Request(env, max_part_size=100).get('f')
+        Traceback (most recent call last):
+          ...
+        HttpError: 413 Request Entity Too Large
+
+        A line break split by the chunk size is not part of the content:
+        >>> payload = '--XyZ\\r\\nContent-Disposition: form-data; name="f"; filename="a.bin"\\r\\n\\r\\n' + 'x' * 65535 + '\\r\\n--XyZ--\\r\\n'
+        >>> env['CONTENT_LENGTH'] = str(len(payload))
+        >>> env['wsgi.input'] = StringIO(payload)
+        >>> f = Request(env).get('f')
+        >>> f.size, f.hash == hashlib.sha1('x' * 65535).hexdigest()
+        (65535, True)
+        '''
+        if not boundary:
+            raise badrequest()
+        delimiter = '--' + boundary
+        terminator = delimiter + '--'
+        reader = _BodyReader(self._environ['wsgi.input'], self._content_length(), self._max_body_size)
+        # skip preamble:
+        while True:
+            line = reader.readline(_MULTIPART_CHUNK)
+            if not line:
+                raise badrequest()
+            line = line.rstrip('\r\n')
+            if line == terminator:
+                return
+            if line == delimiter:
+                break
+        last = False
+        while not last:
+            # part headers:
+            name = filename = content_type = None
+            while True:
+                line = reader.readline(_MULTIPART_CHUNK)
+                if not line:
+                    raise badrequest()
+                line = line.rstrip('\r\n')
+                if not line:
+                    break
+                hname, hsep, hvalue = line.partition(':')
+                hname = hname.strip().lower()
+                if hname == 'content-disposition':
+                    value, params = cgi.parse_header(hvalue)
+                    name = params.get('name')
+                    filename = params.get('filename')
+                elif hname == 'content-type':
+                    content_type = hvalue.strip()
+            if name is None:
+                raise badrequest()
+            sink = _PartSink(filename or None, self._max_part_size, self._spool_size)
+            # the line break before a delimiter belongs to the delimiter, so hold it back:
+            pending = ''
+            line_start = True
+            while True:
+                line = reader.readline(_MULTIPART_CHUNK)
+                if not line:
+                    raise badrequest()
+                if line_start and line.startswith('--'):
+                    s = line.rstrip('\r\n')
+                    if s == delimiter or s == terminator:
+                        last = s == terminator
+                        break
+                if pending == '\r' and line == '\n':
+                    # the second half of a CRLF split by the chunk size:
+                    pending = ''
+                    line = '\r\n'
+                sink.write(pending)
+                if line.endswith('\r\n'):
+                    pending = '\r\n'
+                    line = line[:-2]
+                elif line.endswith('\n'):
+                    pending = '\n'
+                    line = line[:-1]
+                elif line.endswith('\r'):
+                    # may be the first half of a CRLF:
+                    pending = '\r'
+                    line = line[:-1]
+                else:
+                    pending = ''
+                line_start = pending in ('\r\n', '\n')
+                sink.write(line)
+            _add_input(inputs, name, sink.value(content_type))
 
     def _parse_input(self):
-        def _convert(item):
-            if isinstance(item, list):
-                return [_to_unicode(i.value) for i in item]
-            if item.filename:
-                return MultipartFile(item)
-            return _to_unicode(item.value)
-        fs = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
         inputs = dict()
-        for key in fs:
-            inputs[key] = _convert(fs[key])
+        if self._environ.get('REQUEST_METHOD') in ('POST', 'PUT', 'PATCH'):
+            ctype, params = cgi.parse_header(self._environ.get('CONTENT_TYPE', ''))
+            ctype = ctype.lower()
+            if ctype == 'multipart/form-data':
+                self._parse_multipart(inputs, params.get('boundary'))
+            elif ctype == 'application/json':
+                self._parse_json(inputs)
+            else:
+                self._parse_urlencoded(inputs, self._read_body())
+        qs = self._environ.get('QUERY_STRING')
+        if qs:
+            self._parse_urlencoded(inputs, qs)
         return inputs
 
     def _get_raw_input(self):
@@ -708,8 +1490,7 @@ class Request(object):
         >>> r.get_body()
         '<xml><raw/>'
         '''
-        fp = self._environ['wsgi.input']
-        return fp.read()
+        return self._read_body()
 
     @property
     def remote_addr(self):
@@ -1168,25 +1949,95 @@ class Jinja2TemplateEngine(TemplateEngine):
 
     '''
     Render using jinja2 template engine.
+    Args:
+      templ_dir: template directory.
+      bytecode_cache: directory to persist compiled templates, True for a temp
+        directory of jinja2, None to disable.
+      production: do not check template files for changes on each render.
+      stream: return an iterator of utf-8 chunks of chunk_size bytes instead of str.
+      fragment_cache: storage such as LRUCache for {% cache key, ttl %} blocks,
+        None to render them every time.
     >>> templ_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
     >>> engine = Jinja2TemplateEngine(templ_path)
     >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'))
     >>> engine('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12)))
     '<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
+    >>> engine = Jinja2TemplateEngine(templ_path, bytecode_cache=tempfile.mkdtemp(), production=True)
+    >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d'))
+    >>> engine.warm_up()
+    1
+    >>> os.listdir(engine._env.bytecode_cache.directory) != []
+    True
+    >>> engine = Jinja2TemplateEngine(templ_path, stream=True, chunk_size=10)
+    >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d'))
+    >>> list(engine('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1))))
+    ['<p>Hello, ', 'Michael.</p><span>', '2014-06-01', '</span>']
     '''
 
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, bytecode_cache=None, production=False, stream=False, chunk_size=8192, fragment_cache=None, **kw):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+        from fragment import FragmentCacheExtension
         if not 'autoescape' in kw:
             kw['autoescape'] = True
+        kw['extensions'] = list(kw.get('extensions', ())) + [FragmentCacheExtension]
+        if production:
+            kw['auto_reload'] = False
+        if bytecode_cache:
+            if bytecode_cache is True:
+                kw['bytecode_cache'] = FileSystemBytecodeCache()
+            else:
+                if not os.path.isdir(bytecode_cache):
+                    os.makedirs(bytecode_cache)
+                kw['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
         self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        self._env.fragment_cache = fragment_cache
+        self._stream = stream
+        self._chunk_size = chunk_size
+
+    @property
+    def fragment_cache(self):
+        return self._env.fragment_cache
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
+    def warm_up(self):
+        '''
+        Compile all templates so first requests do not pay for it. Call it
+        after all filters are added. Return number of compiled templates.
+        '''
+        n = 0
+        for name in self._env.list_templates():
+            try:
+                self._env.get_template(name)
+                n = n + 1
+            except Exception, e:
+                logger.warning('Compile template %s failed: %s' % (name, e))
+        logger.info('%d template(s) compiled.' % n)
+        return n
+
     def __call__(self, path, model):
+        if self._stream:
+            return _encode_chunks(self._env.get_template(path).generate(**model), self._chunk_size)
         return self._env.get_template(path).render(**model).encode('utf-8')
 
+def _encode_chunks(chunks, chunk_size):
+    '''
+    Encode unicode chunks as utf-8 and join them into chunks of at least chunk_size bytes.
+    '''
+    L = []
+    size = 0
+    for s in chunks:
+        s = s.encode('utf-8')
+        L.append(s)
+        size = size + len(s)
+        if size >= chunk_size:
+            yield ''.join(L)
+            L = []
+            size = 0
+    if L:
+        yield ''.join(L)
+
 def _default_error_handler(e, start_response, is_debug):
     if isinstance(e, HttpError):
         logger.info('HttpError: %s' % e.status)
@@ -1242,74 +2093,157 @@ def _build_pattern_fn(pattern):
         return lambda p: p.endswith(m.group(1))
     raise ValueError('Invalid pattern definition in interceptor.')
 
-def interceptor(pattern='/'):
+def _pattern_applies(pattern, exact, prefix, suffix):
     '''
-    An @interceptor decorator.
+    Check a pattern against all paths of a route: the exact path if known,
+    otherwise the literal prefix and suffix around the route's params.
+    Return True or False if the result is the same for every path, or None
+    if it has to be checked per request.
+    >>> _pattern_applies('/api/', None, '/api/blogs/', '')
+    True
+    >>> _pattern_applies('/api/blogs/1', None, '/api/blogs/', '')
+    >>> _pattern_applies('/manage/', None, '/api/blogs/', '')
+    False
+    >>> _pattern_applies('*.json', None, '/api/', '.json')
+    True
+    >>> _pattern_applies('*.json', '/api/x.html', '/api/x.html', '/api/x.html')
+    False
+    '''
+    m = _RE_INTERCEPTROR_STARTS_WITH.match(pattern)
+    if m:
+        s = m.group(1)
+        if exact is not None:
+            return exact.startswith(s)
+        if prefix.startswith(s):
+            return True
+        return None if s.startswith(prefix) else False
+    m = _RE_INTERCEPTROR_ENDS_WITH.match(pattern)
+    if m:
+        s = m.group(1)
+        if exact is not None:
+            return exact.endswith(s)
+        if suffix.endswith(s):
+            return True
+        return None if s.endswith(suffix) else False
+    raise ValueError('Invalid pattern definition in interceptor.')
+
+def interceptor(pattern='/', exclude=()):
+    '''
+    An @interceptor decorator. Paths matching any of the exclude patterns
+    are skipped.
     @interceptor('/admin/')
     def check_admin(req, resp):
         pass
+    >>> @interceptor('/', exclude='/static/')
+    ... def f(next):
+    ...     return next()
+    >>> f.__interceptor__('/api/'), f.__interceptor__('/static/a.css')
+    (True, False)
     '''
+    if isinstance(exclude, basestring):
+        exclude = (exclude,)
     def _decorator(func):
-        func.__interceptor__ = _build_pattern_fn(pattern)
+        fn = _build_pattern_fn(pattern)
+        excludes = [_build_pattern_fn(p) for p in exclude]
+        if excludes:
+            func.__interceptor__ = lambda p: fn(p) and not any(e(p) for e in excludes)
+        else:
+            func.__interceptor__ = fn
+        func.__interceptor_patterns__ = (pattern, tuple(exclude))
         return func
     return _decorator
 
-def _build_interceptor_fn(func, next):
-    def _wrapper():
-        if func.__interceptor__(ctx.request.path_info):
-            return func(next)
+def _interceptor_applies(func, route):
+    '''
+    Return True, False or None (check per request) if interceptor func applies to route.
+    '''
+    if not hasattr(func, '__interceptor_patterns__'):
+        return None
+    if isinstance(route, Route):
+        if route.is_static:
+            exact = prefix = suffix = route.path
         else:
-            return next()
-    return _wrapper
-
-def _build_interceptor_chain(last_fn, *interceptors):
+            parts = _re_route.split(route.path)
+            exact, prefix, suffix = None, parts[0], parts[-1]
+    else:
+        exact, prefix, suffix = None, route.prefix, ''
+    pattern, excludes = func.__interceptor_patterns__
+    r = _pattern_applies(pattern, exact, prefix, suffix)
+    if r is False:
+        return False
+    for p in excludes:
+        e = _pattern_applies(p, exact, prefix, suffix)
+        if e is True:
+            return False
+        if e is None:
+            r = None
+    return r
+
+class _Endpoint(object):
     '''
-    Build interceptor chain.
-    >>> def target():
-    ...     print 'target'
+    A route with the interceptors that apply to it, resolved once at startup.
+    Interceptors that always apply are called directly, those that depend on
+    the params are checked per request, the others are dropped.
+    >>> def target(id):
+    ...     print 'target', id
     ...     return 123
+    >>> target.__web_route__ = '/api/blogs/:id'
+    >>> target.__web_method__ = 'GET'
     >>> @interceptor('/')
     ... def f1(next):
     ...     print 'before f1()'
     ...     return next()
-    >>> @interceptor('/test/')
+    >>> @interceptor('/api/blogs/1')
     ... def f2(next):
     ...     print 'before f2()'
-    ...     try:
-    ...         return next()
-    ...     finally:
-    ...         print 'after f2()'
-    >>> @interceptor('/')
+    ...     return next()
+    >>> @interceptor('/manage/')
     ... def f3(next):
     ...     print 'before f3()'
-    ...     try:
-    ...         return next()
-    ...     finally:
-    ...         print 'after f3()'
-    >>> chain = _build_interceptor_chain(target, f1, f2, f3)
-    >>> ctx.request = Dict(path_info='/test/abc')
-    >>> chain()
+    ...     return next()
+    >>> endpoint = _Endpoint(Route(target), [f1, f2, f3])
+    >>> len(endpoint.interceptors)
+    2
+    >>> ctx.request = Dict(path_info='/api/blogs/2')
+    >>> endpoint(('2',))
     before f1()
-    before f2()
-    before f3()
-    target
-    after f3()
-    after f2()
+    target 2
     123
-    >>> ctx.request = Dict(path_info='/api/')
-    >>> chain()
+    >>> ctx.request = Dict(path_info='/api/blogs/10')
+    >>> endpoint(('10',))
     before f1()
-    before f3()
-    target
-    after f3()
+    before f2()
+    target 10
     123
     '''
-    L = list(interceptors)
-    L.reverse()
-    fn = last_fn
-    for f in L:
-        fn = _build_interceptor_fn(f, fn)
-    return fn
+    def __init__(self, route, interceptors):
+        self.route = route
+        self.interceptors = []
+        fn = self._call_route
+        for f in reversed(interceptors):
+            applies = _interceptor_applies(f, route)
+            if applies is False:
+                continue
+            self.interceptors.insert(0, f)
+            fn = functools.partial(f, fn) if applies else _build_interceptor_fn(f, fn)
+        self._chain = fn if self.interceptors else None
+
+    def _call_route(self):
+        return self.route(*ctx.request.route_args)
+
+    def __call__(self, args):
+        if self._chain is None:
+            return self.route(*args)
+        ctx.request.route_args = args
+        return self._chain()
+
+def _build_interceptor_fn(func, next):
+    def _wrapper():
+        if func.__interceptor__(ctx.request.path_info):
+            return func(next)
+        else:
+            return next()
+    return _wrapper
 
 def _load_module(module_name):
     '''
@@ -1339,9 +2273,27 @@ class WSGIApplication(object):
         Init a WSGIApplication.
         Args:
           document_root: document root path.
+          max_body_size: max request body size in bytes, default to 10 MB.
+          max_part_size: max size of one multipart part in bytes, default to no limit but max_body_size.
+          spool_size: uploaded file larger than this is spooled to disk, default to 256 KB.
+          static_max_age: max-age of static files in seconds, default to 3600.
+          static_fingerprint_max_age: max-age of fingerprinted static files such as app.3f2a9c1e.js, default to one year.
+          static_cache_size: bytes of static files kept in memory, 0 to disable, default to 0.
+          gzip_level: compress level of dynamic responses, 0 to disable, default to 6.
+          gzip_min_size: dynamic responses smaller than this are not compressed, default to 1024.
         '''
         self._running = False
         self._document_root = document_root
+        self._request_options = dict(
+            max_body_size=kw.get('max_body_size', _MAX_BODY_SIZE),
+            max_part_size=kw.get('max_part_size'),
+            spool_size=kw.get('spool_size', _SPOOL_SIZE))
+        self._static_options = dict(
+            max_age=kw.get('static_max_age', 3600),
+            fingerprint_max_age=kw.get('static_fingerprint_max_age', 31536000),
+            cache_size=kw.get('static_cache_size', 0))
+        self._gzip_level = kw.get('gzip_level', 6)
+        self._gzip_min_size = kw.get('gzip_min_size', 1024)
 
         self._interceptors = []
         self._template_engine = None
@@ -1394,58 +2346,121 @@ class WSGIApplication(object):
         self._interceptors.append(func)
         logger.info('Add interceptor: %s' % str(func))
 
-    def run(self, port=9000, host='127.0.0.1'):
-        from wsgiref.simple_server import make_server
-        #logger.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
+    def run(self, port=9000, host='127.0.0.1', workers=0, max_requests=0, threads=0, **kw):
+        '''
+        Start a server. With workers=0 and threads=0 the application runs in
+        debug mode on wsgiref in one process. threads=N serves keep-alive
+        connections by a pool of N threads, and workers=N forks N worker
+        processes (None for the CPU count), each with its own thread pool if
+        threads is set. With event_loop=True idle keep-alive connections wait
+        in a poll() loop instead of holding threads. Other arguments such as
+        queue_size, timeout and keep_alive go to transwarp.server.ThreadPoolServer.
+        max_requests recycles worker processes, so it only applies with workers.
+        '''
+        if workers == 0 and max_requests:
+            # no master would restart the process:
+            logger.warning('max_requests=%d is ignored without workers.' % max_requests)
+        if workers == 0 and threads:
+            from server import ThreadPoolServer, EventLoopServer
+            server_class = EventLoopServer if kw.pop('event_loop', False) else ThreadPoolServer
+            server = server_class(self.get_wsgi_application(serve_static=True), host, port, threads=threads, **kw)
+            logger.info('application (%s) started at %s:%s...' % (self._document_root, host, port))
+            server.serve_forever()
+            return
+        if workers == 0:
+            from wsgiref.simple_server import make_server
+            #logger.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
+            server = make_server(host, port, self.get_wsgi_application(debug=True))
+            logger.info('application (%s) started at %s:%s...' % (self._document_root, host, port))
+            server.serve_forever()
+            return
+        from server import PreforkServer
+        server = PreforkServer(self.get_wsgi_application(serve_static=True), host, port, workers=workers, max_requests=max_requests, threads=threads, **kw)
         logger.info('application (%s) started at %s:%s...' % (self._document_root, host, port))
         server.serve_forever()
 
-    def get_wsgi_application(self, debug=False):
+    def _should_compress(self):
+        response = ctx.response
+        if not self._gzip_level or response.status_code != 200:
+            return False
+        if response.header('Content-Encoding') or not _compressible(response.content_type):
+            return False
+        vary = response.header('Vary')
+        if not vary:
+            response.set_header('Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            response.set_header('Vary', '%s, Accept-Encoding' % vary)
+        return _accepts_gzip(ctx.request)
+
+    def _compress(self, body):
+        '''
+        Gzip response body if client accepts it and body is large enough.
+        '''
+        if len(body) < self._gzip_min_size or not self._should_compress():
+            return body
+        body = _gzip(body, self._gzip_level)
+        ctx.response.set_header('Content-Encoding', 'gzip')
+        ctx.response.content_length = len(body)
+        return body
+
+    def _compress_stream(self, chunks):
+        '''
+        Gzip streamed response chunk by chunk, each chunk is flushed so the
+        client can start rendering early.
+        '''
+        if not self._should_compress():
+            return chunks
+        ctx.response.set_header('Content-Encoding', 'gzip')
+        return _gzip_stream(chunks, self._gzip_level)
+
+    def _build_router(self, serve_static):
+        router = Router()
+        for route in self._get_static.values() + self._post_static.values() + self._get_dynamic + self._post_dynamic:
+            router.add(route)
+        if serve_static:
+            router.mount(StaticFileRoute(**self._static_options))
+        return router
+
+    def _build_endpoints(self, router):
+        endpoints = {}
+        for route in router.routes():
+            endpoints[route] = _Endpoint(route, self._interceptors)
+            logger.info('Interceptors of %s: %s' % (route, [f.__name__ for f in endpoints[route].interceptors]))
+        return endpoints
+
+    def get_wsgi_application(self, debug=False, serve_static=None):
+        '''
+        Build the wsgi callable. Files under /static/ are served when
+        serve_static is true, which defaults to debug.
+        '''
         self._check_not_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
+        router = self._build_router(debug if serve_static is None else serve_static)
+        endpoints = self._build_endpoints(router)
         self._running = True
 
         _application = Dict(document_root=self._document_root)
 
-        def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method=='GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method=='POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            raise badrequest()
-
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+        def fn_exec():
+            # resolve route first, then run only the interceptors that apply to it:
+            route, args = router.match(ctx.request.request_method, ctx.request.path_info)
+            return endpoints[route](args)
 
         def wsgi(env, start_response):
             ctx.application = _application
-            ctx.request = Request(env)
+            ctx.request = Request(env, **self._request_options)
             response = ctx.response = Response()
             try:
                 r = fn_exec()
                 if isinstance(r, Template):
                     r = self._template_engine(r.template_name, r.model)
+                    if not isinstance(r, basestring):
+                        r = self._compress_stream(r)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                if isinstance(r, str):
+                    r = [self._compress(r)]
                 start_response(response.status, response.headers)
                 return r
             except RedirectError, e:
@@ -1453,7 +2468,7 @@ class WSGIApplication(object):
                 start_response(e.status, response.headers)
                 return []
             except HttpError, e:
-                start_response(e.status, response.headers)
+                start_response(e.status, response.headers + e.headers[1:])
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
                 logger.exception(e)
@@ -13,6 +13,8 @@ from transwarp.web import get, view
 from transwarp.web import get, post, ctx, view, interceptor, seeother, notfound
 from apis import api, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from models import User,Blog,Comment
+from transwarp.orm import identity_map, listen
+from transwarp.cache import LRUCache
 
 from config import configs
 
@@ -21,6 +23,26 @@ logger = logging.getLogger(__name__)
 _COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
+# verified cookie string -> user fields, so identity checks skip the database.
+# The cache is per process: other processes see a change after at most cache_ttl.
+_session_cache = LRUCache(maxsize=configs.session.cache_size, ttl=configs.session.cache_ttl)
+
+def invalidate_sessions(user_id):
+    '''
+    Drop cached sessions of a user, call it after changing users with raw SQL.
+    '''
+    n = _session_cache.evict(lambda cookie, d: d['id'] == user_id)
+    logger.info('invalidate %d cached session(s) of user %s' % (n, user_id))
+
+@listen(User, 'post_update')
+def _on_user_update(user, names):
+    # includes password and admin changes:
+    invalidate_sessions(user.id)
+
+@listen(User, 'post_delete')
+def _on_user_delete(user):
+    invalidate_sessions(user.id)
+
 def make_signed_cookie(id,password,max_age):
     # build cookie string by: id-expires-md5
     expires = str(int(time.time() + (max_age or 86400)))
@@ -29,18 +51,25 @@ def make_signed_cookie(id,password,max_age):
 
 def parse_signed_cookie(cookie_str):
     #try:
-    cookie = ctx.request.cookies.get(_COOKIE_NAME)
     L = cookie_str.split('-')
     if len(L) != 3:
         return None
     id,expires,md5 = L
-    if int(expires) < time.time():
+    expires_at = int(expires)
+    now = time.time()
+    if expires_at < now:
         return None
+    d = _session_cache.get(cookie_str)
+    if d is not None:
+        # a clean copy, so update() only writes what the handler changes:
+        return User._factory(d.keys())(d.values())
     user = User.get(id)
     if user is None:
         return None
     if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, _COOKIE_KEY)).hexdigest():
         return None
+    # cache a copy so handlers changing the user cannot alter the cached one:
+    _session_cache.set(cookie_str, dict(user), ttl=min(configs.session.cache_ttl, expires_at - now))
     return user
     #except:
     #    logger.info('error------------')
@@ -52,7 +81,13 @@ def check_admin():
         return
     raise APIPermissionError('No permission.')
 
-@interceptor('/')
+@interceptor('/', exclude='/static/')
+def identity_map_interceptor(next):
+    # repeated primary key loads within one request hit the identity map:
+    with identity_map():
+        return next()
+
+@interceptor('/', exclude=('/static/', '/api/authenticate'))
 def user_interceptor(next):
     logger.info('try to bind user from session cookie...')
     user = None
@@ -17,8 +17,11 @@ import time
 
 from transwarp import db
 from transwarp.web import WSGIApplication, Jinja2TemplateEngine
+from transwarp.orm import listen
+from transwarp.cache import LRUCache, FileCache
 
 from config import configs
+from models import Blog
 
 logger = logging.getLogger(__name__)
 
@@ -39,18 +42,40 @@ def datetime_filter(t):
 
 
 # init db
-db.create_engine(**configs.db)
+_db_configs = dict(configs.db)
+_sqlite = _db_configs.pop('sqlite', None)
+if _sqlite:
+    db.create_sqlite_engine(_sqlite, pool=_db_configs['pool'], stmt_cache_size=_db_configs['stmt_cache_size'], max_packet=_db_configs['max_packet'])
+else:
+    db.create_engine(**_db_configs)
 
 # init wsgi app
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), **configs.web)
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+# init template fragment cache
+_fragment_configs = configs.templates.fragment_cache
+if _fragment_configs.directory:
+    fragment_cache = FileCache(_fragment_configs.directory, ttl=_fragment_configs.ttl)
+else:
+    fragment_cache = LRUCache(_fragment_configs.size, ttl=_fragment_configs.ttl)
+
+@listen(Blog, 'post_insert')
+@listen(Blog, 'post_update')
+@listen(Blog, 'post_delete')
+def _invalidate_blog_fragments(blog, *args):
+    fragment_cache.delete('blogs')
+
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'), bytecode_cache=configs.templates.bytecode_cache, production=configs.templates.production, stream=configs.templates.stream, chunk_size=configs.templates.chunk_size, fragment_cache=fragment_cache)
 
 template_engine.add_filter('datetime', datetime_filter)
 
+if configs.templates.warm_up:
+    template_engine.warm_up()
+
 wsgi.template_engine = template_engine
 
 import urls
+wsgi.add_interceptor(urls.identity_map_interceptor)
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)
@@ -61,5 +86,5 @@ if __name__=='__main__':
     logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
     #print os.path.dirname(os.path.abspath(__file__))
     #print os.path.abspath(__file__)
-    wsgi.run(port=9000,host='0.0.0.0')
+    wsgi.run(port=9000,host='0.0.0.0', **configs.server)
 